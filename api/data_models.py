@@ -1,8 +1,11 @@
 
 from pydantic import BaseModel
-from typing import List
+from typing import List, Literal, Optional
 from datetime import datetime
 
+# Same values as src.solvers.SOLVERS, which is not imported here so the API starts without scipy
+Solver = Literal['lp', 'exact', 'slsqp']
+
 class TradeInput(BaseModel):
     security_id: int
     market_value: float
@@ -10,10 +13,44 @@ class TradeInput(BaseModel):
 class AllocateTradeRequest(BaseModel):
     as_of_date: datetime
     trades: List[TradeInput]
+    solver: Solver = 'lp'
+    decompose: bool = False
+    include_timings: bool = False
+    profile: bool = False
+    # Id the allocation is kept under for incremental re-allocation, generated if not provided
+    request_id: Optional[str] = None
+    # Earlier allocation of the same basket, by request id (kept by the worker that allocated it, solved in full
+    # when unknown) or as returned in allocations
+    prior_request_id: Optional[str] = None
+    prior_allocations: Optional[List[dict]] = None
 
 class AllocationResponse(BaseModel):
     allocations: List[dict]
     status: str
+    request_id: Optional[str] = None
+    timings: Optional[dict] = None
+
+class TradeBasket(BaseModel):
+    basket_id: str
+    trades: List[TradeInput]
+
+class AllocateTradesBatchRequest(BaseModel):
+    as_of_date: datetime
+    baskets: List[TradeBasket]
+    solver: Solver = 'lp'
+    include_timings: bool = False
+    profile: bool = False
+
+class BasketAllocation(BaseModel):
+    basket_id: str
+    allocations: List[dict]
+    status: str
+    error: Optional[str] = None
+
+class BatchAllocationResponse(BaseModel):
+    results: List[BasketAllocation]
+    status: str
+    timings: Optional[dict] = None
 
 class OptimizationPriority(BaseModel):
     metric_name: str
@@ -25,3 +62,41 @@ class SetOptimizationPrioritiesRequest(BaseModel):
 class OptimizationPrioritiesResponse(BaseModel):
     priorities: List[dict]
     status: str
+
+class AllocationConstraint(BaseModel):
+    # 'pb_capacity', 'pb_share' or 'security_limit'
+    constraint_type: str
+    counterparty: str
+    security_id: Optional[int] = None
+    min_value: Optional[float] = None
+    max_value: Optional[float] = None
+
+class SetAllocationConstraintsRequest(BaseModel):
+    constraints: List[AllocationConstraint]
+
+class AllocationConstraintsResponse(BaseModel):
+    constraints: List[dict]
+    status: str
+
+class PriorityScenario(BaseModel):
+    scenario_id: str
+    priorities: List[OptimizationPriority]
+
+class AllocateTradeScenariosRequest(BaseModel):
+    as_of_date: datetime
+    trades: List[TradeInput]
+    scenarios: List[PriorityScenario]
+    solver: Solver = 'lp'
+    include_timings: bool = False
+    profile: bool = False
+
+class ScenarioAllocation(BaseModel):
+    scenario_id: str
+    allocations: List[dict]
+    objective: float
+    metrics: List[dict]
+
+class ScenarioAllocationResponse(BaseModel):
+    results: List[ScenarioAllocation]
+    status: str
+    timings: Optional[dict] = None
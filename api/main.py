@@ -1,15 +1,96 @@
-from fastapi import FastAPI, HTTPException, Depends, Body
+from fastapi import FastAPI, HTTPException, Depends, Body, Query, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-import pandas as pd
-import sqlite3
+import asyncio
+import logging
+import os
+import time
+from contextlib import asynccontextmanager, closing
 from datetime import datetime
+from typing import Optional, TYPE_CHECKING
 import secrets
-from api.data_models import AllocateTradeRequest, AllocationResponse, SetOptimizationPrioritiesRequest, OptimizationPrioritiesResponse
-from src.pb_optimizer import PBOptimizer
-from src.data.data_access_layer import DataAccessLayer
-from src.data.initialize_data import initialize_mock_data
+import uuid
+from api.response_encoding import JSON, negotiate_format, stream_dataframes, dataframe_chunks
+from api.data_models import AllocateTradeRequest, AllocationResponse, SetOptimizationPrioritiesRequest, OptimizationPrioritiesResponse, \
+    AllocateTradesBatchRequest, BatchAllocationResponse, BasketAllocation, AllocateTradeScenariosRequest, \
+    ScenarioAllocationResponse, ScenarioAllocation, SetAllocationConstraintsRequest, AllocationConstraintsResponse
+from src.errors import OptimizerBusyError, InfeasibleAllocationError
+from src.instrumentation import StageTimer, MetricsRegistry, NULL_TIMER
 
-app = FastAPI(title="PB Optimization API", version="1.0.0")
+# pandas, scipy and the optimizer are imported by start_services once the server is up, not when this module is
+# imported, so a new worker answers /health right away
+if TYPE_CHECKING:
+    import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DATABASE = os.environ.get("PB_OPTIMIZER_DB", "portfolio.db")
+# Set by start_services
+dao = None
+optimizer = None
+startup = {"ready": False, "error": None, "seconds": None}
+# Allocation stage timings are aggregated for /metrics unless disabled
+metrics = MetricsRegistry() if os.environ.get("PB_OPTIMIZER_METRICS", "1") != "0" else None
+
+
+def start_services():
+    """
+    Open the database and create the optimizer. The data is not loaded here: run python -m src.data.initialize_data
+    (or set PB_OPTIMIZER_LOAD_MOCK_DATA=1 in development), the database must be at the current schema version
+    """
+    global dao, optimizer
+    start = time.perf_counter()
+    from src.data.data_access_layer import DataAccessLayer, ConnectionPool
+    from src.data.initialize_data import SCHEMA_VERSION, initialize_mock_data, schema_version
+    from src.pb_optimizer import PBOptimizer
+
+    # Each worker thread gets its own connection so reads and optimizations do not share a cursor
+    pool = ConnectionPool(DATABASE)
+    with closing(pool.connect()) as db_conn:
+        if os.environ.get("PB_OPTIMIZER_LOAD_MOCK_DATA", "0") == "1":
+            initialize_mock_data(db_conn)
+        version = schema_version(db_conn)
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(f"{DATABASE} is at schema version {version}, expected {SCHEMA_VERSION}: run "
+                           f"python -m src.data.initialize_data --db {DATABASE}")
+    dao = DataAccessLayer(pool)
+    # Concurrency limits for the optimizer, requests beyond workers + queue get a 503
+    # Dates exported with src.data.snapshot_files are memory mapped from this directory, shared by every worker.
+    # Allocations of the same date received within the batch window are solved together
+    optimizer = PBOptimizer(dao, max_workers=int(os.environ.get("PB_OPTIMIZER_MAX_WORKERS", 4)),
+                            max_queued=int(os.environ.get("PB_OPTIMIZER_MAX_QUEUED", 16)),
+                            snapshot_directory=os.environ.get("PB_OPTIMIZER_SNAPSHOT_DIR"),
+                            batch_window=float(os.environ.get("PB_OPTIMIZER_BATCH_WINDOW_MS", 0)) / 1000)
+    startup["seconds"] = time.perf_counter() - start
+    startup["ready"] = True
+
+
+def run_startup():
+    try:
+        start_services()
+    except Exception as e:
+        logger.exception("Startup failed")
+        startup["error"] = str(e)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Started in the background so the server accepts connections (and answers /health) while it starts
+    started = asyncio.get_running_loop().run_in_executor(None, run_startup)
+    yield
+    await started
+    if optimizer is not None:
+        optimizer.close()
+
+
+def require_ready():
+    """Reject requests with a 503 until start_services has completed"""
+    if not startup["ready"]:
+        detail = f"Startup failed: {startup['error']}" if startup["error"] else "Service is starting"
+        raise HTTPException(status_code=503, detail=detail, headers={"Retry-After": "1"})
+
+
+app = FastAPI(title="PB Optimization API", version="1.0.0", lifespan=lifespan)
 security = HTTPBasic()
 
 # Simple username/password storage (in production, use a secure database)
@@ -30,19 +111,44 @@ def authenticate_user(credentials: HTTPBasicCredentials = Depends(security)):
         )
     return username
 
-# Initialize database connection and data access layer
-db_conn = sqlite3.connect("portfolio.db", check_same_thread=False)
-# Initialize mock data on startup
-initialize_mock_data(db_conn)
-dao = DataAccessLayer(db_conn)
-optimizer = PBOptimizer(dao)
+@app.get("/health", tags=["Monitoring"])
+def health():
+    """Liveness: the server is up, whether or not it is ready"""
+    return {"status": "ok"}
+
+@app.get("/ready", tags=["Monitoring"])
+def ready():
+    """Readiness: 200 once the database is open and the optimizer created, 503 before that or if startup failed"""
+    if not startup["ready"]:
+        return JSONResponse(status_code=503, content={"status": "error" if startup["error"] else "starting",
+                                                      "error": startup["error"]})
+    return {"status": "ready", "startup_seconds": startup["seconds"]}
+
+def create_timer(include_timings: bool, profile: bool) -> Optional[StageTimer]:
+    """Return a timer if metrics are enabled or the request asked for timings, None otherwise"""
+    if metrics is None and not include_timings and not profile:
+        return None
+    return StageTimer(profile=profile)
 
-@app.get("/positions", tags=["Data Access"])
-async def get_positions(as_of_date: str = '2024-01-15', current_user: str = Depends(authenticate_user)):
+def observe_timer(timer: Optional[StageTimer], endpoint: str, status: str):
+    if metrics is not None and timer is not None:
+        metrics.observe(timer.report(), endpoint, status)
+
+@app.get("/positions", tags=["Data Access"], dependencies=[Depends(require_ready)])
+def get_positions(as_of_date: str = '2024-01-15', response_format: Optional[str] = Query(None, alias="format"),
+                  accept: Optional[str] = Header(None), current_user: str = Depends(authenticate_user)):
+    """
+    Positions of as_of_date. format=ndjson or format=columnar (or the matching Accept header) streams the rows from
+    the database in chunks instead of building the whole response in memory
+    """
+    response_format = negotiate_format(response_format, accept)
     try:
         # Convert string date to datetime
         date_obj = datetime.fromisoformat(as_of_date)
-        
+
+        if response_format != JSON:
+            return stream_dataframes(dao.iter_positions(date_obj), response_format)
+
         # Get positions from data access layer
         positions_df = dao.get_positions(date_obj, None)
         
@@ -57,12 +163,23 @@ async def get_positions(as_of_date: str = '2024-01-15', current_user: str = Depe
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving positions: {str(e)}")
 
-@app.get("/security-coefficients", tags=["Data Access"])
-async def get_security_coefficients(as_of_date: str = '2024-01-15', security_id: int = None, current_user: str = Depends(authenticate_user)):
+@app.get("/security-coefficients", tags=["Data Access"], dependencies=[Depends(require_ready)])
+def get_security_coefficients(as_of_date: str = '2024-01-15', security_id: int = None,
+                              response_format: Optional[str] = Query(None, alias="format"),
+                              accept: Optional[str] = Header(None), current_user: str = Depends(authenticate_user)):
+    """
+    Security coefficients of as_of_date. format=ndjson or format=columnar (or the matching Accept header) streams the
+    rows from the database in chunks instead of building the whole response in memory
+    """
+    response_format = negotiate_format(response_format, accept)
     try:
         # Convert string date to datetime
         date_obj = datetime.fromisoformat(as_of_date)
-        
+
+        if response_format != JSON:
+            return stream_dataframes(dao.iter_security_pb_coefficients(date_obj, [security_id] if security_id else None),
+                                     response_format)
+
         # Get security coefficients from data access layer
         coefficients_df = dao.get_security_pb_coefficients(
             date_obj, 
@@ -81,8 +198,9 @@ async def get_security_coefficients(as_of_date: str = '2024-01-15', security_id:
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving security coefficients: {str(e)}")
 
-@app.get("/optimization-priorities", response_model=OptimizationPrioritiesResponse, tags=["Data Access"])
-async def get_optimization_priorities(current_user: str = Depends(authenticate_user)):
+@app.get("/optimization-priorities", response_model=OptimizationPrioritiesResponse, tags=["Data Access"],
+         dependencies=[Depends(require_ready)])
+def get_optimization_priorities(current_user: str = Depends(authenticate_user)):
     try:
         # Get optimization priorities from data access layer
         priorities_df = dao.get_optimization_priorities()
@@ -98,8 +216,10 @@ async def get_optimization_priorities(current_user: str = Depends(authenticate_u
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error retrieving optimization priorities: {str(e)}")
 
-@app.post("/optimization-priorities", response_model=OptimizationPrioritiesResponse, tags=["Data Access"])
-async def set_optimization_priorities(request: SetOptimizationPrioritiesRequest, current_user: str = Depends(authenticate_user)):
+@app.post("/optimization-priorities", response_model=OptimizationPrioritiesResponse, tags=["Data Access"],
+          dependencies=[Depends(require_ready)])
+def set_optimization_priorities(request: SetOptimizationPrioritiesRequest, current_user: str = Depends(authenticate_user)):
+    import pandas as pd
     try:
         # Convert Pydantic models to DataFrame
         priorities_data = []
@@ -133,14 +253,81 @@ async def set_optimization_priorities(request: SetOptimizationPrioritiesRequest,
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error setting optimization priorities: {str(e)}")
 
+def constraints_to_list(constraints_df: "pd.DataFrame") -> list:
+    # NaN is not valid JSON, missing values are returned as null
+    return constraints_df.astype(object).where(constraints_df.notna(), None).to_dict('records')
+
+@app.get("/allocation-constraints", response_model=AllocationConstraintsResponse, tags=["Data Access"],
+         dependencies=[Depends(require_ready)])
+def get_allocation_constraints(current_user: str = Depends(authenticate_user)):
+    try:
+        return AllocationConstraintsResponse(constraints=constraints_to_list(dao.get_allocation_constraints()),
+                                             status="success")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error retrieving allocation constraints: {str(e)}")
+
+@app.post("/allocation-constraints", response_model=AllocationConstraintsResponse, tags=["Data Access"],
+          dependencies=[Depends(require_ready)])
+def set_allocation_constraints(request: SetAllocationConstraintsRequest,
+                               current_user: str = Depends(authenticate_user)):
+    """
+    Replace the allocation constraints applied to every allocation:
+
+    - pb_capacity: market value held with the counterparty after the allocation (its positions of the date plus the
+      traded market value allocated to it) between min_value and max_value
+    - pb_share: share (0 to 1) of a trade list's traded market value allocated to the counterparty between min_value
+      and max_value
+    - security_limit: traded market value of security_id allocated to the counterparty at most max_value, e.g. a
+      locate limit
+
+    Allocations with constraints are always solved with the LP solver.
+    """
+    import pandas as pd
+    from src.constraints import CONSTRAINT_COLUMNS, validate_constraints
+    try:
+        constraints_df = pd.DataFrame([constraint.model_dump() for constraint in request.constraints],
+                                      columns=CONSTRAINT_COLUMNS)
+        try:
+            validate_constraints(constraints_df)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        dao.set_allocation_constraints(constraints_df)
+        return AllocationConstraintsResponse(constraints=constraints_to_list(dao.get_allocation_constraints()),
+                                             status="success")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error setting allocation constraints: {str(e)}")
+
+def trades_to_dataframe(trades) -> "pd.DataFrame":
+    import pandas as pd
+    trade_data = []
+    for trade in trades:
+        trade_data.append({
+            "security_id": trade.security_id,
+            "market_value": trade.market_value
+        })
+    return pd.DataFrame(trade_data, columns=["security_id", "market_value"])
+
+def allocations_to_list(allocations_df: "pd.DataFrame") -> list:
+    return [{k: v} for k, v in allocations_df.to_dict('index').items()] if not allocations_df.empty else []
+
+def allocations_to_dataframe(allocations_list: list) -> "pd.DataFrame":
+    """Inverse of allocations_to_list"""
+    import pandas as pd
+    allocations = {int(security_id): allocation for item in allocations_list for security_id, allocation in item.items()}
+    return pd.DataFrame.from_dict(allocations, orient='index')
+
 allocate_trade_example = [{"as_of_date": "2024-01-15T00:00:00",
                           "trades": [{"security_id": 1001, "market_value": 50000},
                                      {"security_id": 1002, "market_value": 10000}
                                      ]}]
 
-@app.post("/allocate_trade", response_model=AllocationResponse, tags=['Optimization'])
+@app.post("/allocate_trade", response_model=AllocationResponse, tags=['Optimization'],
+          dependencies=[Depends(require_ready)])
 async def allocate_trade(request: AllocateTradeRequest = Body(..., examples=allocate_trade_example),
-                         current_user: str = Depends(authenticate_user)):
+                         response_format: Optional[str] = Query(None, alias="format"),
+                         accept: Optional[str] = Header(None), current_user: str = Depends(authenticate_user)):
     """
     Allocate trades across prime brokerage accounts.
     
@@ -154,31 +341,183 @@ async def allocate_trade(request: AllocateTradeRequest = Body(..., examples=allo
         ]
     }
     ```
+
+    To re-allocate an amended basket, pass the request_id of the earlier response as prior_request_id (or its
+    allocations as prior_allocations). Securities traded for the same market value keep their allocation and only
+    the amended ones are solved. Request ids are only known to the worker that allocated them, an unknown id is
+    solved in full.
+
+    format=ndjson (one line per security) or format=columnar, or the matching Accept header, stream the allocations
+    with the request id in the X-Request-Id header. Timings are only returned in the JSON format.
     """
+    response_format = negotiate_format(response_format, accept)
+    timer = create_timer(request.include_timings, request.profile)
+    status = "error"
     try:
-        # Convert Pydantic models to DataFrame for business logic
-        trade_data = []
-        for trade in request.trades:
-            trade_data.append({
-                "security_id": trade.security_id,
-                "market_value": trade.market_value
-            })
-        
-        trade_df = pd.DataFrame(trade_data)
-        
-        # Call business logic
-        allocations_df = await optimizer.allocate_trade_list(request.as_of_date, trade_df)
-        
-        # Convert result back to response format
-        allocations_list = [{k: v} for k, v in allocations_df.to_dict('index').items()] if not allocations_df.empty else []
-        
+        with (timer or NULL_TIMER).stage('total'):
+            # Convert Pydantic models to DataFrame for business logic
+            trade_df = trades_to_dataframe(request.trades)
+            request_id = request.request_id or uuid.uuid4().hex
+            prior_allocation = request.prior_request_id
+            if prior_allocation is None and request.prior_allocations is not None:
+                prior_allocation = allocations_to_dataframe(request.prior_allocations)
+
+            # Call business logic
+            allocations_df = await optimizer.allocate_trade_list(request.as_of_date, trade_df, request.solver,
+                                                                 request.decompose, timer, request_id,
+                                                                 prior_allocation)
+
+            # Convert result back to response format
+            with (timer or NULL_TIMER).stage('format_response'):
+                if response_format != JSON:
+                    allocations = allocations_df.rename_axis('security_id').reset_index()
+                    status = "success"
+                    return stream_dataframes(dataframe_chunks(allocations), response_format,
+                                             headers={"X-Request-Id": request_id})
+                allocations_list = allocations_to_list(allocations_df)
+        status = "success"
+
         return AllocationResponse(
             allocations=allocations_list,
-            status="success"
+            status="success",
+            request_id=request_id,
+            timings=timer.report() if request.include_timings or request.profile else None
         )
         
+    except OptimizerBusyError as e:
+        status = "rejected"
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except InfeasibleAllocationError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing trade allocation: {str(e)}")
+    finally:
+        observe_timer(timer, "allocate_trade", status)
+
+allocate_trades_batch_example = [{"as_of_date": "2024-01-15T00:00:00",
+                                  "baskets": [{"basket_id": "basket_1",
+                                               "trades": [{"security_id": 1001, "market_value": 50000}]},
+                                              {"basket_id": "basket_2",
+                                               "trades": [{"security_id": 1002, "market_value": 10000},
+                                                          {"security_id": 1003, "market_value": 20000}]}
+                                              ]}]
+
+@app.post("/allocate_trades/batch", response_model=BatchAllocationResponse, tags=['Optimization'],
+          dependencies=[Depends(require_ready)])
+async def allocate_trades_batch(request: AllocateTradesBatchRequest = Body(..., examples=allocate_trades_batch_example),
+                                current_user: str = Depends(authenticate_user)):
+    """
+    Allocate several independent trade baskets for the same date. The date's data is loaded once for all baskets,
+    a basket that fails is reported with status "error" without failing the others.
+    """
+    timer = create_timer(request.include_timings, request.profile)
+    status = "error"
+    try:
+        with (timer or NULL_TIMER).stage('total'):
+            trade_lists = [trades_to_dataframe(basket.trades) for basket in request.baskets]
+
+            # Call business logic
+            allocation_results = await optimizer.allocate_trade_lists(request.as_of_date, trade_lists, request.solver,
+                                                                      timer)
+
+            # Convert results back to response format
+            results = []
+            with (timer or NULL_TIMER).stage('format_response'):
+                for basket, allocation_result in zip(request.baskets, allocation_results):
+                    if allocation_result.error is None:
+                        results.append(BasketAllocation(basket_id=basket.basket_id,
+                                                        allocations=allocations_to_list(allocation_result.allocations),
+                                                        status="success"))
+                    else:
+                        results.append(BasketAllocation(basket_id=basket.basket_id, allocations=[], status="error",
+                                                        error=allocation_result.error))
+        status = "success" if all(result.status == "success" for result in results) else "partial"
+
+        return BatchAllocationResponse(
+            results=results,
+            status=status,
+            timings=timer.report() if request.include_timings or request.profile else None
+        )
+
+    except OptimizerBusyError as e:
+        status = "rejected"
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing trade allocation batch: {str(e)}")
+    finally:
+        observe_timer(timer, "allocate_trades_batch", status)
+
+allocate_trade_scenarios_example = [{"as_of_date": "2024-01-15T00:00:00",
+                                     "trades": [{"security_id": 1001, "market_value": 50000},
+                                                {"security_id": 1002, "market_value": 10000}],
+                                     "scenarios": [{"scenario_id": "metric_a",
+                                                    "priorities": [{"metric_name": "METRIC_A", "weight": 1.0}]},
+                                                   {"scenario_id": "balanced",
+                                                    "priorities": [{"metric_name": "METRIC_A", "weight": 0.5},
+                                                                   {"metric_name": "METRIC_B", "weight": 0.5}]}]}]
+
+@app.post("/allocate_trade/scenarios", response_model=ScenarioAllocationResponse, tags=['Optimization'],
+          dependencies=[Depends(require_ready)])
+async def allocate_trade_scenarios(request: AllocateTradeScenariosRequest = Body(..., examples=allocate_trade_scenarios_example),
+                                   current_user: str = Depends(authenticate_user)):
+    """
+    Allocate a trade list under several sets of optimization priorities, without changing the stored priorities.
+    Each scenario returns its allocations, objective and the value and weighted contribution of each metric.
+    """
+    import pandas as pd
+    timer = create_timer(request.include_timings, request.profile)
+    status = "error"
+    try:
+        with (timer or NULL_TIMER).stage('total'):
+            trade_df = trades_to_dataframe(request.trades)
+            scenarios = [pd.DataFrame([{"metric_name": priority.metric_name, "weight": priority.weight}
+                                       for priority in scenario.priorities], columns=["metric_name", "weight"])
+                         for scenario in request.scenarios]
+
+            # Call business logic
+            scenario_results = await optimizer.evaluate_scenarios(request.as_of_date, trade_df, scenarios,
+                                                                  request.solver, timer)
+
+            # Convert results back to response format
+            with (timer or NULL_TIMER).stage('format_response'):
+                results = [ScenarioAllocation(scenario_id=scenario.scenario_id,
+                                              allocations=allocations_to_list(result.allocations),
+                                              objective=result.objective,
+                                              metrics=[{"metric_name": metric_name, "value": value,
+                                                        "contribution": result.metric_contributions[metric_name]}
+                                                       for metric_name, value in result.metric_values.items()])
+                           for scenario, result in zip(request.scenarios, scenario_results)]
+        status = "success"
+
+        return ScenarioAllocationResponse(
+            results=results,
+            status="success",
+            timings=timer.report() if request.include_timings or request.profile else None
+        )
+
+    except OptimizerBusyError as e:
+        status = "rejected"
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+    except InfeasibleAllocationError as e:
+        # Before ValueError, which it derives from
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing trade allocation scenarios: {str(e)}")
+    finally:
+        observe_timer(timer, "allocate_trade_scenarios", status)
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["Monitoring"], dependencies=[Depends(require_ready)])
+def get_metrics(current_user: str = Depends(authenticate_user)):
+    """
+    Allocation stage timings, problem dimensions, solver statistics and snapshot cache statistics in the Prometheus
+    text format
+    """
+    if metrics is None:
+        raise HTTPException(status_code=404, detail="Metrics are disabled (PB_OPTIMIZER_METRICS=0)")
+    gauges = {f"snapshot_cache_{name}": value for name, value in optimizer.snapshot_cache.stats().items()}
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,78 @@
+import json
+from typing import Iterable, Iterator, Optional, TYPE_CHECKING
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+# Only dataframe methods are used here, pandas is not imported with the app
+if TYPE_CHECKING:
+    import pandas as pd
+
+JSON = 'json'
+NDJSON = 'ndjson'
+COLUMNAR = 'columnar'
+
+MEDIA_TYPES = {
+    JSON: 'application/json',
+    # One JSON record per line
+    NDJSON: 'application/x-ndjson',
+    # {"columns": [...], "batches": [{"column": [values], ...}, ...], "status": "success"}, one batch per chunk read
+    COLUMNAR: 'application/vnd.pb-optimizer.columnar+json',
+}
+
+
+def negotiate_format(response_format: Optional[str], accept: Optional[str]) -> str:
+    """
+    Return the response format requested by the format query parameter, or else by the Accept header. Defaults to
+    JSON
+    """
+    if response_format:
+        if response_format not in MEDIA_TYPES:
+            raise HTTPException(status_code=400, detail=f"Unknown format '{response_format}', expected one of "
+                                                        f"{list(MEDIA_TYPES)}")
+        return response_format
+    accepted = [media_type.split(';')[0].strip() for media_type in (accept or '').split(',')]
+    for name, media_type in MEDIA_TYPES.items():
+        if media_type in accepted and name != JSON:
+            return name
+    return JSON
+
+
+def ndjson_lines(chunks: Iterable["pd.DataFrame"]) -> Iterator[str]:
+    for chunk in chunks:
+        if not chunk.empty:
+            yield chunk.to_json(orient='records', lines=True, date_format='iso').rstrip('\n') + '\n'
+
+
+def columnar_batches(chunks: Iterable["pd.DataFrame"]) -> Iterator[str]:
+    started = False
+    for chunk in chunks:
+        if not started:
+            yield '{"columns": ' + json.dumps([str(column) for column in chunk.columns]) + ', "batches": ['
+            started = True
+        elif chunk.empty:
+            continue
+        else:
+            yield ', '
+        yield '{' + ', '.join(f'{json.dumps(str(column))}: {chunk[column].to_json(orient="values", date_format="iso")}'
+                              for column in chunk.columns) + '}'
+    if not started:
+        yield '{"columns": [], "batches": ['
+    yield '], "status": "success"}'
+
+
+def stream_dataframes(chunks: Iterable["pd.DataFrame"], response_format: str,
+                      headers: Optional[dict] = None) -> StreamingResponse:
+    """
+    Stream dataframe chunks as NDJSON or columnar JSON, encoding one chunk at a time
+    :param chunks: dataframes, typically read from the database cursor as the response is sent
+    :param response_format: NDJSON or COLUMNAR
+    :param headers: [Optional] extra response headers
+    :return:
+    """
+    body = ndjson_lines(chunks) if response_format == NDJSON else columnar_batches(chunks)
+    return StreamingResponse(body, media_type=MEDIA_TYPES[response_format], headers=headers)
+
+
+def dataframe_chunks(df: "pd.DataFrame", chunk_size: int = 10000) -> Iterator["pd.DataFrame"]:
+    for start in range(0, max(len(df), 1), chunk_size):
+        yield df.iloc[start:start + chunk_size]
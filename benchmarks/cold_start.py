@@ -0,0 +1,82 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure_import(module: str = 'api.main') -> float:
+    """
+    Seconds to import module in a fresh interpreter
+    """
+    code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+    output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def wait_for(url: str, deadline: float) -> float:
+    """
+    Poll url until it returns 200
+    :return: time.perf_counter() of the first 200
+    """
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except (urllib.error.URLError, ConnectionError, OSError):
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f"{url} did not return 200 in time")
+
+
+def measure_worker_start(database: str, port: int, timeout: float = 60.0) -> dict:
+    """
+    Start one uvicorn worker and time it until /health (accepting connections) and /ready (optimizer created) return
+    200
+    :return: live_seconds and ready_seconds from the process start
+    """
+    env = {**os.environ, 'PB_OPTIMIZER_DB': database}
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'api.main:app', '--port', str(port),
+                                '--log-level', 'warning'], cwd=ROOT, env=env)
+    try:
+        deadline = start + timeout
+        live = wait_for(f'http://127.0.0.1:{port}/health', deadline)
+        ready = wait_for(f'http://127.0.0.1:{port}/ready', deadline)
+    finally:
+        process.terminate()
+        process.wait()
+    return {'live_seconds': live - start, 'ready_seconds': ready - start}
+
+
+def run_cold_start(database: str, port: int = 8765, runs: int = 5) -> dict:
+    imports = [measure_import() for _ in range(runs)]
+    starts = [measure_worker_start(database, port) for _ in range(runs)]
+    return {'database': database, 'runs': runs,
+            'import_seconds': float(np.median(imports)),
+            'live_seconds': float(np.median([start['live_seconds'] for start in starts])),
+            'ready_seconds': float(np.median([start['ready_seconds'] for start in starts]))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold start of an API worker")
+    parser.add_argument('--db', default='portfolio.db',
+                        help="SQLite database, already initialized with python -m src.data.initialize_data")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = run_cold_start(os.path.abspath(args.db), args.port, args.runs)
+    print(f"median of {results['runs']} runs: import api.main {results['import_seconds'] * 1000:.0f}ms, "
+          f"/health {results['live_seconds'] * 1000:.0f}ms, /ready {results['ready_seconds'] * 1000:.0f}ms")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
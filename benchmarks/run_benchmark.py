@@ -0,0 +1,249 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+import numpy as np
+import scipy
+from benchmarks.synthetic_data import create_benchmark_database, generate_book, generate_constraints, \
+    generate_trade_list
+from src.data.data_access_layer import DataAccessLayer, ConnectionPool
+from src.instrumentation import StageTimer
+from src.pb_optimizer import PBOptimizer
+
+# Results compared by --compare, with the direction that counts as a regression
+COMPARED_RESULTS = {
+    ('cold', 'p50_seconds'): 'higher', ('cold', 'p90_seconds'): 'higher',
+    ('warm', 'p50_seconds'): 'higher', ('warm', 'p90_seconds'): 'higher',
+    ('warm', 'throughput_per_second'): 'lower',
+    ('memory', 'peak_traced_bytes'): 'higher',
+    ('endpoint', 'p50_seconds'): 'higher',
+}
+
+
+def summarize_latencies(latencies: list) -> dict:
+    latencies = np.asarray(latencies)
+    return {'runs': len(latencies),
+            'mean_seconds': float(latencies.mean()),
+            'p50_seconds': float(np.percentile(latencies, 50)),
+            'p90_seconds': float(np.percentile(latencies, 90)),
+            'p99_seconds': float(np.percentile(latencies, 99)),
+            'max_seconds': float(latencies.max()),
+            'throughput_per_second': float(len(latencies) / latencies.sum())}
+
+
+def summarize_stages(reports: list) -> dict:
+    """
+    Mean wall and CPU seconds by stage over StageTimer reports
+    """
+    stages = {}
+    for report in reports:
+        for name, timing in report['stages'].items():
+            totals = stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+            totals['wall_seconds'] += timing['wall_seconds'] / len(reports)
+            totals['cpu_seconds'] += timing['cpu_seconds'] / len(reports)
+    return stages
+
+
+def run_allocations(optimizer: PBOptimizer, as_of_date: datetime, trade_lists: list, solver: str,
+                    cold: bool) -> tuple:
+    """
+    Allocate each trade list, dropping the cached snapshots before each one if cold
+    :return: latencies, StageTimer reports and objective values
+    """
+    latencies, reports, objectives = [], [], []
+    for trade_list in trade_lists:
+        if cold:
+            optimizer.invalidate_snapshots()
+        timer = StageTimer()
+        start = time.perf_counter()
+        optimizer.allocate_trade_list_sync(as_of_date, trade_list, solver, timer=timer)
+        latencies.append(time.perf_counter() - start)
+        report = timer.report()
+        reports.append(report)
+        objectives.append(report['solver'].get('objective'))
+    return latencies, reports, objectives
+
+
+def run_endpoint(config: dict, as_of_date: datetime, trade_lists: list) -> dict:
+    """
+    Time /allocate_trade end to end (validation, auth, serialization) with the FastAPI test client
+    """
+    try:
+        from fastapi.testclient import TestClient
+    except (ImportError, RuntimeError) as e:
+        return {'skipped': f"FastAPI test client not available: {e}"}
+
+    os.environ['PB_OPTIMIZER_DB'] = config['db']
+    from api import main
+    latencies = []
+    with TestClient(main.app) as client:
+        while client.get('/ready').status_code == 503 and main.startup['error'] is None:
+            time.sleep(0.01)
+        for trade_list in trade_lists:
+            payload = {'as_of_date': as_of_date.isoformat(), 'solver': config['solver'],
+                       'trades': trade_list.to_dict('records')}
+            start = time.perf_counter()
+            response = client.post('/allocate_trade', json=payload, auth=('user', 'secret123'))
+            latencies.append(time.perf_counter() - start)
+            response.raise_for_status()
+    return summarize_latencies(latencies)
+
+
+def book_arguments(config: dict) -> dict:
+    return {'as_of_date': config['as_of_date'], 'n_pbs': config['pbs'], 'n_metrics': config['metrics'],
+            'n_securities': config['securities'], 'sparsity': config['sparsity'], 'seed': config['seed']}
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_benchmark(config: dict) -> dict:
+    """
+    Generate the synthetic book, then measure cold (empty snapshot cache) and warm allocations, stage timings,
+    memory and optionally the endpoint
+    :param config: parsed command line arguments
+    :return: results
+    """
+    start = time.perf_counter()
+    # The book is seeded, so these are the positions create_benchmark_database loads
+    positions, _, _ = generate_book(**book_arguments(config))
+    constraints = generate_constraints(config['constraints'], config['pbs'], config['securities'],
+                                       config['trade_size'], config['seed'], positions)
+    loaded = create_benchmark_database(config['db'], constraints=constraints, **book_arguments(config))
+    load_seconds = time.perf_counter() - start
+
+    as_of_date = datetime.fromisoformat(config['as_of_date'])
+    trade_lists = [generate_trade_list(config['securities'], config['trade_size'], seed=config['seed'] + i + 1)
+                   for i in range(config['iterations'])]
+    optimizer = PBOptimizer(DataAccessLayer(ConnectionPool(config['db'])))
+    try:
+        cold_latencies, cold_reports, objectives = run_allocations(optimizer, as_of_date, trade_lists,
+                                                                   config['solver'], cold=True)
+        # Warm runs find every security of the date in the snapshot cache
+        optimizer.get_snapshot(as_of_date)
+        warm_latencies, warm_reports, _ = run_allocations(optimizer, as_of_date, trade_lists, config['solver'],
+                                                          cold=False)
+
+        # Traced separately as tracemalloc slows the allocation down
+        optimizer.invalidate_snapshots()
+        tracemalloc.start()
+        optimizer.allocate_trade_list_sync(as_of_date, trade_lists[0], config['solver'])
+        peak_traced_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        optimizer.close()
+
+    results = {
+        'config': config,
+        'environment': {'git_revision': git_revision(), 'python': platform.python_version(),
+                        'numpy': np.__version__, 'scipy': scipy.__version__, 'machine': platform.machine(),
+                        'cpus': os.cpu_count()},
+        'database': {'load_seconds': load_seconds, 'records': loaded},
+        'cold': {**summarize_latencies(cold_latencies), 'stages': summarize_stages(cold_reports)},
+        'warm': {**summarize_latencies(warm_latencies), 'stages': summarize_stages(warm_reports)},
+        'memory': {'peak_traced_bytes': peak_traced_bytes,
+                   # kilobytes on Linux
+                   'max_rss_kilobytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss},
+        'objectives': objectives,
+        'dimensions': cold_reports[0]['dimensions'],
+    }
+    if config['endpoint']:
+        results['endpoint'] = run_endpoint(config, as_of_date, trade_lists)
+    return results
+
+
+def compare_results(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return the regressions of results against baseline
+    :param results:
+    :param baseline: results of an earlier run
+    :param tolerance: relative change allowed before a result counts as a regression
+    :return: list of messages, empty if there is no regression
+    """
+    regressions = []
+    for (section, name), worse in COMPARED_RESULTS.items():
+        old = baseline.get(section, {}).get(name)
+        new = results.get(section, {}).get(name)
+        if old is None or new is None or old == 0:
+            continue
+        change = (new - old) / old
+        if (worse == 'higher' and change > tolerance) or (worse == 'lower' and -change > tolerance):
+            regressions.append(f"{section}.{name}: {old:.6g} -> {new:.6g} ({change:+.1%})")
+
+    # Same book and trade lists, so the objectives should not move
+    workload = ['as_of_date', 'pbs', 'metrics', 'securities', 'sparsity', 'seed', 'trade_size', 'constraints', 'solver']
+    if all(baseline.get('config', {}).get(key) == results['config'].get(key) for key in workload):
+        for i, (old, new) in enumerate(zip(baseline.get('objectives', []), results['objectives'])):
+            if old is not None and new is not None and not np.isclose(old, new, rtol=1e-6, atol=1e-6):
+                regressions.append(f"objective of trade list {i}: {old:.10g} -> {new:.10g}")
+    return regressions
+
+
+def print_summary(results: dict) -> None:
+    dimensions = results['dimensions']
+    print(f"{dimensions.get('pbs')} PBs x {dimensions.get('metrics')} metrics x "
+          f"{dimensions.get('securities')} traded securities, {dimensions.get('constraint_rows', 0)} constraint rows, "
+          f"solver {results['config']['solver']}, "
+          f"database loaded in {results['database']['load_seconds']:.2f}s")
+    for section in ['cold', 'warm', 'endpoint']:
+        summary = results.get(section)
+        if summary is None:
+            continue
+        if 'skipped' in summary:
+            print(f"{section:>8}: {summary['skipped']}")
+            continue
+        print(f"{section:>8}: p50 {summary['p50_seconds'] * 1000:.1f}ms  p90 {summary['p90_seconds'] * 1000:.1f}ms  "
+              f"p99 {summary['p99_seconds'] * 1000:.1f}ms  {summary['throughput_per_second']:.1f}/s")
+        for name, timing in summary.get('stages', {}).items():
+            print(f"{'':>10}{name:<30} {timing['wall_seconds'] * 1000:9.2f}ms wall "
+                  f"{timing['cpu_seconds'] * 1000:9.2f}ms cpu")
+    memory = results['memory']
+    print(f"  memory: peak traced {memory['peak_traced_bytes'] / 2 ** 20:.1f}MiB, "
+          f"max rss {memory['max_rss_kilobytes'] / 1024:.1f}MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark trade allocation on a synthetic book")
+    parser.add_argument('--pbs', type=int, default=6, help="number of PBs")
+    parser.add_argument('--metrics', type=int, default=3, help="number of metrics")
+    parser.add_argument('--securities', type=int, default=5000, help="number of securities in the book")
+    parser.add_argument('--sparsity', type=float, default=0.2,
+                        help="fraction of PB/security pairs without coefficients")
+    parser.add_argument('--trade-size', type=int, default=500, help="number of trades per trade list")
+    parser.add_argument('--constraints', type=int, default=0,
+                        help="number of allocation constraints (PB shares and capacities, then security limits)")
+    parser.add_argument('--iterations', type=int, default=20, help="number of trade lists")
+    parser.add_argument('--solver', default='lp', help="'lp', 'exact' or 'slsqp'")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--as-of-date', default='2024-06-28')
+    parser.add_argument('--db', default=os.path.join(os.path.dirname(__file__), 'benchmark.db'),
+                        help="SQLite database the synthetic book is written to")
+    parser.add_argument('--endpoint', action='store_true', help="also time /allocate_trade through FastAPI")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results of an earlier run, exits with 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="relative change allowed by --compare before reporting a regression")
+    args = parser.parse_args()
+
+    results = run_benchmark(vars(args))
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, default=str)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,132 @@
+import sqlite3
+import numpy as np
+import pandas as pd
+from typing import Optional
+from src.constraints import CONSTRAINT_COLUMNS
+from src.data.initialize_data import create_schema, load_dataframes
+
+FIRST_SECURITY_ID = 100000
+
+
+def generate_book(as_of_date: str, n_pbs: int = 6, n_metrics: int = 3, n_securities: int = 5000,
+                  sparsity: float = 0.0, seed: int = 0) -> tuple:
+    """
+    Generate synthetic positions, PB coefficients and optimization priorities for one date
+    :param as_of_date: 'YYYY-MM-DD'
+    :param n_pbs: number of counterparties
+    :param n_metrics: number of metrics
+    :param n_securities: number of securities
+    :param sparsity: fraction of (PB, security) pairs without coefficients. Every security keeps at least one PB
+    :param seed:
+    :return: positions, coefficients and priorities dataframes with the columns expected by load_dataframes
+    """
+    rng = np.random.default_rng(seed)
+    pb_codes = np.array([f'PB_{i:02d}' for i in range(n_pbs)])
+    metric_names = np.array([f'METRIC_{i:02d}' for i in range(n_metrics)])
+    security_ids = FIRST_SECURITY_ID + np.arange(n_securities)
+
+    pairs = rng.random((n_pbs, n_securities)) >= sparsity
+    pairs[rng.integers(n_pbs, size=n_securities), np.arange(n_securities)] = True
+    pb_idx, security_idx = np.nonzero(pairs)
+
+    # Metrics have different magnitudes, as the real coefficients do, so the normalization matters
+    metric_scale = 10 ** rng.uniform(-1, 2, size=n_metrics)
+    n_pairs = len(pb_idx)
+    coefficients = pd.DataFrame({
+        'as_of_date': as_of_date,
+        'counterparty': np.repeat(pb_codes[pb_idx], n_metrics),
+        'security_id': np.repeat(security_ids[security_idx], n_metrics),
+        'metric_name': np.tile(metric_names, n_pairs),
+        'coefficient_value': rng.random(n_pairs * n_metrics) * np.tile(metric_scale, n_pairs),
+    })
+
+    held = rng.random(n_pairs) < 0.5
+    quantity = rng.integers(100, 10000, size=held.sum())
+    positions = pd.DataFrame({
+        'as_of_date': as_of_date,
+        'portfolio': 'PORTFOLIO_A',
+        'counterparty': pb_codes[pb_idx[held]],
+        'security_id': security_ids[security_idx[held]],
+        'quantity': quantity,
+        'market_value': quantity * rng.uniform(10, 500, size=held.sum()),
+    })
+
+    weights = rng.random(n_metrics)
+    priorities = pd.DataFrame({'metric_name': metric_names, 'weight': weights / weights.sum()})
+    return positions, coefficients, priorities
+
+
+def generate_trade_list(n_securities: int, trade_size: int, seed: int = 0, sell_fraction: float = 0.1) -> pd.DataFrame:
+    """
+    Generate a trade list of distinct securities from a book generated by generate_book
+    :param n_securities: number of securities in the book
+    :param trade_size: number of trades
+    :param seed:
+    :param sell_fraction: fraction of trades with a negative market value
+    :return: dataframe with security_id and market_value columns
+    """
+    rng = np.random.default_rng(seed)
+    security_ids = FIRST_SECURITY_ID + rng.choice(n_securities, size=min(trade_size, n_securities), replace=False)
+    market_value = rng.uniform(1000, 1000000, size=len(security_ids))
+    market_value[rng.random(len(security_ids)) < sell_fraction] *= -1
+    return pd.DataFrame({'security_id': security_ids, 'market_value': market_value})
+
+
+def generate_constraints(n_constraints: int, n_pbs: int = 6, n_securities: int = 5000, trade_size: int = 500,
+                         seed: int = 0, positions: Optional[pd.DataFrame] = None) -> pd.DataFrame:
+    """
+    Generate feasible allocation constraints for a book generated by generate_book: a share range and a capacity by
+    PB, the rest are per-security limits
+    :param n_constraints: number of constraints
+    :param n_pbs: number of counterparties
+    :param n_securities: number of securities in the book
+    :param trade_size: number of trades per trade list, used to size the capacities
+    :param seed:
+    :param positions: [Optional] positions of the book, capacities are on top of what each PB already holds
+    :return: dataframe with CONSTRAINT_COLUMNS
+    """
+    rng = np.random.default_rng(seed)
+    pb_codes = np.array([f'PB_{i:02d}' for i in range(n_pbs)])
+    held = np.zeros(n_pbs)
+    if positions is not None:
+        held = positions.groupby('counterparty')['market_value'].sum().reindex(pb_codes).fillna(0).to_numpy()
+    n_pb_constraints = min(n_constraints, 2 * n_pbs)
+    pb_idx = np.arange(n_pb_constraints) % n_pbs
+    # generate_trade_list trades up to 1,000,000 per security
+    pb_constraints = pd.DataFrame({
+        'constraint_type': np.where(np.arange(n_pb_constraints) < n_pbs, 'pb_share', 'pb_capacity'),
+        'counterparty': pb_codes[pb_idx],
+        'security_id': None,
+        'min_value': np.where(np.arange(n_pb_constraints) < n_pbs, 0.2 / n_pbs, np.nan),
+        'max_value': np.where(np.arange(n_pb_constraints) < n_pbs, 2.0 / n_pbs,
+                              held[pb_idx] + trade_size * 1e6 / n_pbs),
+    })
+    n_limits = n_constraints - n_pb_constraints
+    security_limits = pd.DataFrame({
+        'constraint_type': 'security_limit',
+        'counterparty': pb_codes[rng.integers(n_pbs, size=n_limits)],
+        'security_id': FIRST_SECURITY_ID + rng.integers(n_securities, size=n_limits),
+        'min_value': np.nan,
+        'max_value': rng.uniform(0, 1000000, size=n_limits),
+    })
+    return pd.concat([pb_constraints, security_limits], ignore_index=True)[CONSTRAINT_COLUMNS]
+
+
+def create_benchmark_database(path: str, as_of_date: str, constraints: pd.DataFrame = None, **book_config) -> dict:
+    """
+    Create (or replace the date in) a SQLite database with a synthetic book
+    :param path: SQLite database file
+    :param as_of_date: 'YYYY-MM-DD'
+    :param constraints: [Optional] allocation constraints replacing the existing ones, no constraints if not provided
+    :param book_config: arguments of generate_book
+    :return: number of records loaded by table
+    """
+    positions, coefficients, priorities = generate_book(as_of_date, **book_config)
+    if constraints is None:
+        constraints = pd.DataFrame(columns=CONSTRAINT_COLUMNS)
+    db_conn = sqlite3.connect(path)
+    try:
+        create_schema(db_conn)
+        return load_dataframes(db_conn, positions, coefficients, priorities, constraints)
+    finally:
+        db_conn.close()
@@ -0,0 +1,92 @@
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class PriorAllocation:
+    """
+    Allocation of an earlier trade list, used to re-allocate an amended version of it incrementally
+    """
+    # Fraction of each security's trade allocated to each PB, indexed by security_id with one column by PB
+    fractions: pd.DataFrame
+    # Traded market value by security_id
+    trade: pd.Series
+    as_of_date: Optional[str] = None
+    # Data version and priorities the allocation was solved with, None when unknown (allocations passed back by the
+    # caller), in which case the caller vouches that they are still valid
+    data_version: Optional[int] = None
+    optimization_priorities: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_allocations(cls, allocations: pd.DataFrame) -> 'PriorAllocation':
+        """
+        Build a prior from allocations returned by PBOptimizer.format_results (market value by security and PB). The
+        trade of each security is the sum of its allocations
+        :param allocations: dataframe indexed by security_id with one column by PB
+        :return:
+        """
+        allocations = allocations.fillna(0).astype(float)
+        trade = allocations.sum(axis=1)
+        fractions = allocations.div(trade.replace(0, 1), axis=0)
+        return cls(fractions=fractions, trade=trade)
+
+    def is_compatible(self, as_of_date: datetime, data_version: int, optimization_priorities: np.ndarray,
+                      pb_codes: np.ndarray) -> bool:
+        """
+        Return True if the allocations of unchanged securities can be reused for a solve with these inputs
+        """
+        if self.as_of_date is not None and self.as_of_date != as_of_date.strftime('%Y-%m-%d'):
+            return False
+        if self.data_version is not None and self.data_version != data_version:
+            return False
+        if self.optimization_priorities is not None and not (
+                self.optimization_priorities.shape == optimization_priorities.shape and
+                np.allclose(self.optimization_priorities, optimization_priorities)):
+            return False
+        return pd.Index(self.fractions.columns).isin(pb_codes).all()
+
+    def unchanged(self, security_index: pd.Index, trade: np.ndarray) -> np.ndarray:
+        """
+        Return a boolean mask of the securities of security_index traded for the same market value as in the prior
+        :param security_index:
+        :param trade: traded market value aligned to security_index
+        :return:
+        """
+        prior_trade = self.trade.reindex(security_index).to_numpy(dtype=float)
+        return np.isclose(prior_trade, trade, rtol=1e-9, atol=1e-6) & ~np.isnan(prior_trade)
+
+    def select(self, security_index: pd.Index, pb_codes: np.ndarray) -> np.ndarray:
+        """
+        Return the (pb, security) allocation fractions for security_index, zero for securities not in the prior
+        """
+        return self.fractions.reindex(index=security_index, columns=pb_codes).fillna(0).to_numpy(dtype=float).T
+
+
+class AllocationStore:
+    """
+    Thread safe LRU store of PriorAllocation by allocation id
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._allocations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, allocation_id: str) -> Optional[PriorAllocation]:
+        with self._lock:
+            prior = self._allocations.get(allocation_id)
+            if prior is not None:
+                self._allocations.move_to_end(allocation_id)
+            return prior
+
+    def put(self, allocation_id: str, prior: PriorAllocation) -> None:
+        with self._lock:
+            self._allocations[allocation_id] = prior
+            self._allocations.move_to_end(allocation_id)
+            while len(self._allocations) > self.max_entries:
+                self._allocations.popitem(last=False)
@@ -0,0 +1,212 @@
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime
+from typing import Optional
+from src.data.data_access_layer import DataAccessLayer, ConnectionPool
+from src.pb_optimizer import PBOptimizer
+from src.snapshot_cache import SnapshotCache
+
+BLOTTER_COLUMNS = ['as_of_date', 'security_id', 'market_value']
+ALLOCATION_COLUMNS = ['as_of_date', 'basket_id', 'security_id', 'counterparty', 'market_value']
+CONTRIBUTION_COLUMNS = ['as_of_date', 'basket_id', 'metric_name', 'value', 'weight', 'contribution', 'objective']
+ERROR_COLUMNS = ['as_of_date', 'basket_id', 'error']
+
+
+def run_backtest(database: str, blotter: pd.DataFrame, output_directory: str, start_date: Optional[datetime] = None,
+                 end_date: Optional[datetime] = None, solver: str = 'lp', processes: Optional[int] = None,
+                 snapshot_directory: Optional[str] = None, overwrite: bool = False) -> dict:
+    """
+    Replay a trade blotter over a range of dates with the current optimization priorities. Dates are split in
+    contiguous chunks run in parallel processes, each process loads the next date's data while the current date is
+    solving. The allocations and per-metric contributions of each date are written to
+    output_directory/allocations/<date>.csv and output_directory/contributions/<date>.csv as soon as the date is done.
+    Dates with a basket that failed get output_directory/errors/<date>.csv instead and are replayed by the next run
+    :param database: SQLite database file
+    :param blotter: dataframe with as_of_date, security_id and market_value columns, and optionally basket_id to
+        allocate several trade lists per date (the whole date is one trade list otherwise)
+    :param output_directory:
+    :param start_date: [Optional] first date replayed, the first date of the blotter if not provided
+    :param end_date: [Optional] last date replayed, the last date of the blotter if not provided
+    :param solver: 'lp' (HiGHS), 'exact' (closed form) or 'slsqp'
+    :param processes: [Optional] number of processes, defaults to the CPU count
+    :param snapshot_directory: [Optional] directory of snapshot files used before the database
+    :param overwrite: replay dates that already have results in output_directory
+    :return: number of dates and baskets replayed, dates skipped, dates failed, errors and elapsed seconds
+    """
+    start = time.perf_counter()
+    missing = set(BLOTTER_COLUMNS).difference(blotter.columns)
+    if missing:
+        raise ValueError(f"Blotter is missing columns {sorted(missing)}")
+    blotter = blotter.copy()
+    blotter['as_of_date'] = pd.to_datetime(blotter['as_of_date']).dt.strftime('%Y-%m-%d')
+    if 'basket_id' not in blotter.columns:
+        blotter['basket_id'] = blotter['as_of_date']
+    if start_date is not None:
+        blotter = blotter[blotter['as_of_date'] >= start_date.strftime('%Y-%m-%d')]
+    if end_date is not None:
+        blotter = blotter[blotter['as_of_date'] <= end_date.strftime('%Y-%m-%d')]
+
+    for subdirectory in ['allocations', 'contributions', 'errors']:
+        os.makedirs(os.path.join(output_directory, subdirectory), exist_ok=True)
+    dates = np.sort(blotter['as_of_date'].unique())
+    skipped = [date for date in dates if not overwrite and _has_results(output_directory, date)]
+    dates = [date for date in dates if date not in skipped]
+
+    summary = {'dates': 0, 'baskets': 0, 'skipped_dates': len(skipped), 'failed_dates': 0, 'errors': []}
+    chunks = [chunk.tolist() for chunk in np.array_split(np.array(dates), min(processes or os.cpu_count(),
+                                                                              max(len(dates), 1))) if chunk.size]
+    if chunks:
+        with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(run_dates, database, blotter[blotter['as_of_date'].isin(chunk)], chunk,
+                                   output_directory, solver, snapshot_directory) for chunk in chunks]
+            for future in futures:
+                chunk_summary = future.result()
+                summary['dates'] += chunk_summary['dates']
+                summary['baskets'] += chunk_summary['baskets']
+                summary['failed_dates'] += chunk_summary['failed_dates']
+                summary['errors'] += chunk_summary['errors']
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def run_dates(database: str, blotter: pd.DataFrame, dates: list, output_directory: str, solver: str = 'lp',
+              snapshot_directory: Optional[str] = None) -> dict:
+    """
+    Replay dates in order in the calling process, prefetching the data of the next date in a background thread
+    :return: number of dates and baskets replayed, dates failed and errors
+    """
+    # Only the current and the prefetched date are needed
+    optimizer = PBOptimizer(DataAccessLayer(ConnectionPool(database)), snapshot_cache=SnapshotCache(max_entries=2),
+                            max_workers=1, snapshot_directory=snapshot_directory)
+    optimization_priorities = optimizer.dao.get_optimization_priorities()
+    trade_lists = dict(tuple(blotter.groupby('as_of_date')))
+    summary = {'dates': 0, 'baskets': 0, 'failed_dates': 0, 'errors': []}
+
+    def prefetch(date: str):
+        return optimizer.get_snapshot(datetime.fromisoformat(date),
+                                      pd.Index(trade_lists[date]['security_id'].unique()))
+
+    prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix='backtest_prefetch')
+    try:
+        future = prefetcher.submit(prefetch, dates[0]) if dates else None
+        for i, date in enumerate(dates):
+            try:
+                future.result()
+            except Exception:
+                # Each basket loads the data it is missing and reports its own error
+                pass
+            future = prefetcher.submit(prefetch, dates[i + 1]) if i + 1 < len(dates) else None
+
+            allocations, contributions, errors = [], [], []
+            for basket_id, trade_list in trade_lists[date].groupby('basket_id', sort=False):
+                try:
+                    result = optimizer.evaluate_scenarios_sync(datetime.fromisoformat(date), trade_list,
+                                                               [optimization_priorities], solver)[0]
+                except Exception as e:
+                    errors.append({'as_of_date': date, 'basket_id': basket_id, 'error': str(e)})
+                    continue
+                allocations.append(format_allocations(date, basket_id, result.allocations))
+                contributions.append(format_contributions(date, basket_id, result, optimization_priorities))
+            if errors:
+                # A partial date is not a result, it is replayed by the next run
+                write_errors(output_directory, date, errors)
+                summary['errors'] += errors
+                summary['failed_dates'] += 1
+                continue
+            write_results(output_directory, date, allocations, contributions)
+            summary['baskets'] += len(allocations)
+            summary['dates'] += 1
+    finally:
+        prefetcher.shutdown(wait=True)
+        optimizer.close()
+    return summary
+
+
+def format_allocations(date: str, basket_id, allocations: pd.DataFrame) -> pd.DataFrame:
+    """
+    Long format of the allocations returned by the optimizer, without the zero allocations
+    """
+    allocations = allocations.rename_axis(index='security_id', columns='counterparty').stack()
+    allocations = allocations[allocations != 0].rename('market_value').reset_index()
+    allocations.insert(0, 'basket_id', basket_id)
+    allocations.insert(0, 'as_of_date', date)
+    return allocations[ALLOCATION_COLUMNS]
+
+
+def format_contributions(date: str, basket_id, result, optimization_priorities: pd.DataFrame) -> pd.DataFrame:
+    weights = optimization_priorities.set_index('metric_name')['weight']
+    contributions = pd.DataFrame({'metric_name': list(result.metric_values),
+                                  'value': list(result.metric_values.values()),
+                                  'contribution': list(result.metric_contributions.values())})
+    contributions['weight'] = weights.reindex(contributions['metric_name']).fillna(0).to_numpy()
+    contributions['objective'] = result.objective
+    contributions.insert(0, 'basket_id', basket_id)
+    contributions.insert(0, 'as_of_date', date)
+    return contributions[CONTRIBUTION_COLUMNS]
+
+
+def write_results(output_directory: str, date: str, allocations: list, contributions: list) -> None:
+    """
+    Write the results of a date. Each file is written under a temporary name and renamed, so a date only has results
+    once they are complete. The errors of a previous run of the date are removed
+    """
+    for subdirectory, frames, columns in [('allocations', allocations, ALLOCATION_COLUMNS),
+                                          ('contributions', contributions, CONTRIBUTION_COLUMNS)]:
+        path = os.path.join(output_directory, subdirectory, f'{date}.csv')
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        df.to_csv(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    _remove(os.path.join(output_directory, 'errors', f'{date}.csv'))
+
+
+def write_errors(output_directory: str, date: str, errors: list) -> None:
+    """
+    Write the basket errors of a date and remove its results from a previous run, so the date is not treated as done
+    """
+    for subdirectory in ['allocations', 'contributions']:
+        _remove(os.path.join(output_directory, subdirectory, f'{date}.csv'))
+    path = os.path.join(output_directory, 'errors', f'{date}.csv')
+    pd.DataFrame(errors, columns=ERROR_COLUMNS).to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _has_results(output_directory: str, date: str) -> bool:
+    return all(os.path.exists(os.path.join(output_directory, subdirectory, f'{date}.csv'))
+               for subdirectory in ['allocations', 'contributions'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a trade blotter over a range of dates")
+    parser.add_argument('--db', default='portfolio.db', help="SQLite database file")
+    parser.add_argument('--blotter', required=True,
+                        help="CSV with as_of_date, security_id, market_value and optionally basket_id columns")
+    parser.add_argument('--output', required=True, help="directory the results are written to")
+    parser.add_argument('--start', help="first date, YYYY-MM-DD")
+    parser.add_argument('--end', help="last date, YYYY-MM-DD")
+    parser.add_argument('--solver', default='lp', help="'lp', 'exact' or 'slsqp'")
+    parser.add_argument('--processes', type=int, help="number of processes, defaults to the CPU count")
+    parser.add_argument('--snapshot-directory', help="directory of snapshot files used before the database")
+    parser.add_argument('--overwrite', action='store_true', help="replay dates that already have results")
+    args = parser.parse_args()
+
+    summary = run_backtest(args.db, pd.read_csv(args.blotter), args.output,
+                           datetime.fromisoformat(args.start) if args.start else None,
+                           datetime.fromisoformat(args.end) if args.end else None, args.solver, args.processes,
+                           args.snapshot_directory, args.overwrite)
+    for error in summary['errors']:
+        print(f"{error['as_of_date']} {error['basket_id'] or ''}: {error['error']}")
+    print(f"Replayed {summary['dates']} dates and {summary['baskets']} baskets in {summary['seconds']:.1f}s, "
+          f"{summary['skipped_dates']} dates already had results, {summary['failed_dates']} dates failed with "
+          f"{len(summary['errors'])} errors")
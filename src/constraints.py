@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+from dataclasses import dataclass
+from scipy import sparse
+from typing import Optional
+
+# pb_capacity: market value held with the PB after the allocation (its positions of the date plus the traded market
+# value allocated to it) between min_value and max_value
+# pb_share: share (0 to 1) of the trade list's traded market value allocated to the PB between min_value and max_value
+# security_limit: traded market value of security_id allocated to the PB at most max_value, e.g. a locate limit
+CONSTRAINT_TYPES = ('pb_capacity', 'pb_share', 'security_limit')
+CONSTRAINT_COLUMNS = ['constraint_type', 'counterparty', 'security_id', 'min_value', 'max_value']
+
+
+@dataclass
+class LinearConstraints:
+    """
+    Allocation constraints compiled for one problem: A_ub @ allocations_flat <= b_ub and
+    0 <= allocations <= upper_bounds, on top of the per-security sum constraints
+    """
+    A_ub: Optional[sparse.csr_array]
+    b_ub: Optional[np.ndarray]
+    # (pb, security) array
+    upper_bounds: np.ndarray
+
+    @property
+    def n_rows(self) -> int:
+        return 0 if self.A_ub is None else int(self.A_ub.shape[0])
+
+    @property
+    def couples_securities(self) -> bool:
+        """
+        True if some constraint involves several securities, so securities can no longer be solved independently
+        """
+        return self.n_rows > 0
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.couples_securities and bool((self.upper_bounds >= 1).all())
+
+
+def validate_constraints(constraints: pd.DataFrame) -> None:
+    """
+    :raises ValueError: if a constraint has an unknown type or is missing the values its type needs
+    """
+    unknown = set(constraints['constraint_type']).difference(CONSTRAINT_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown constraint types {sorted(unknown)}, expected one of {list(CONSTRAINT_TYPES)}")
+    if constraints['counterparty'].isna().any():
+        raise ValueError("Every constraint needs a counterparty")
+    security_limits = constraints['constraint_type'] == 'security_limit'
+    if (security_limits & (constraints['security_id'].isna() | constraints['max_value'].isna())).any():
+        raise ValueError("security_limit constraints need a security_id and a max_value")
+    if (security_limits & constraints['min_value'].notna()).any():
+        raise ValueError("security_limit constraints only take a max_value")
+    if (constraints['min_value'].isna() & constraints['max_value'].isna()).any():
+        raise ValueError("Every constraint needs a min_value or a max_value")
+
+
+def compile_constraints(constraints: pd.DataFrame, pb_codes: np.ndarray, security_index: pd.Index,
+                        trade: np.ndarray, pb_positions: Optional[np.ndarray] = None) -> LinearConstraints:
+    """
+    Compile the declarative constraints into sparse linear constraints on the flattened (pb, security) allocations of
+    one trade list. Only bought securities are allocated, so values are relative to the bought market value.
+    Constraints on PBs or securities that are not part of the problem are ignored
+    :param constraints: dataframe with CONSTRAINT_COLUMNS
+    :param pb_codes:
+    :param security_index:
+    :param trade: traded market value aligned to security_index
+    :param pb_positions: [Optional] market value of the date's positions held with each PB, aligned to pb_codes.
+        pb_capacity limits apply to the traded market value alone if not provided
+    :return:
+    """
+    n_pbs, n_securities = len(pb_codes), len(security_index)
+    bought = np.where(trade > 0, trade, 0.0)
+    upper_bounds = np.ones((n_pbs, n_securities))
+    if constraints is None or constraints.empty:
+        return LinearConstraints(A_ub=None, b_ub=None, upper_bounds=upper_bounds)
+
+    pb_idx = pd.Index(pb_codes).get_indexer(constraints['counterparty'])
+    constraints = constraints.assign(pb_idx=pb_idx)[pb_idx >= 0]
+
+    # Per security limits are bounds on single variables
+    limits = constraints[constraints['constraint_type'] == 'security_limit']
+    security_idx = security_index.get_indexer(limits['security_id'])
+    limits = limits[security_idx >= 0].assign(security_idx=security_idx[security_idx >= 0])
+    limits = limits[bought[limits['security_idx']] > 0]
+    if not limits.empty:
+        bound = limits['max_value'].to_numpy(dtype=float) / bought[limits['security_idx']]
+        np.minimum.at(upper_bounds, (limits['pb_idx'].to_numpy(), limits['security_idx'].to_numpy()),
+                      np.clip(bound, 0, 1))
+
+    # PB capacities and shares are rows over every security of the PB, lower limits are negated upper limits
+    rows = []
+    b_ub = []
+    total = bought.sum()
+    for constraint in constraints[constraints['constraint_type'] != 'security_limit'].itertuples(index=False):
+        # Capacities are on the market value held with the PB, which already includes its existing positions
+        if constraint.constraint_type == 'pb_capacity':
+            scale, held = 1.0, pb_positions[constraint.pb_idx] if pb_positions is not None else 0.0
+        elif constraint.constraint_type == 'pb_share':
+            scale, held = total, 0.0
+        else:
+            raise ValueError(f"Unknown constraint type {constraint.constraint_type}, expected one of "
+                             f"{list(CONSTRAINT_TYPES)}")
+        if pd.notna(constraint.max_value):
+            rows.append((constraint.pb_idx, 1.0))
+            b_ub.append(constraint.max_value * scale - held)
+        if pd.notna(constraint.min_value):
+            rows.append((constraint.pb_idx, -1.0))
+            b_ub.append(held - constraint.min_value * scale)
+    if not rows:
+        return LinearConstraints(A_ub=None, b_ub=None, upper_bounds=upper_bounds)
+
+    row_pb_idx = np.array([pb for pb, _ in rows])
+    row_sign = np.array([sign for _, sign in rows])
+    row_idx = np.repeat(np.arange(len(rows)), n_securities)
+    col_idx = (row_pb_idx[:, None] * n_securities + np.arange(n_securities)).reshape(-1)
+    data = (row_sign[:, None] * bought).reshape(-1)
+    A_ub = sparse.csr_array((data, (row_idx, col_idx)), shape=(len(rows), n_pbs * n_securities))
+    return LinearConstraints(A_ub=A_ub, b_ub=np.array(b_ub, dtype=float), upper_bounds=upper_bounds)
@@ -1,37 +1,127 @@
 import sqlite3
+import threading
 import pandas as pd
-from typing import Optional
+from typing import Iterator, Optional, Union
 from datetime import datetime
+from src.constraints import validate_constraints
+from src.data.initialize_data import bump_data_version, get_data_loads, read_data_version
+
+# Maximum number of security ids bound in a single IN filter
+MAX_QUERY_PARAMETERS = 900
+# Rows fetched from the cursor at a time by the iter_ methods
+DEFAULT_CHUNK_SIZE = 10000
+
+
+class ConnectionPool:
+    """
+    Hands out one SQLite connection per thread so concurrent requests do not share a connection
+    """
+
+    def __init__(self, database: str, timeout: float = 5.0):
+        """
+        :param database: SQLite database file (or URI)
+        :param timeout: seconds to wait for a lock held by another connection
+        """
+        self.database = database
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.connect()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open a new connection that is not managed by the pool, the caller closes it
+        """
+        connection = sqlite3.connect(self.database, timeout=self.timeout, check_same_thread=False,
+                                     uri=self.database.startswith('file:'))
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def close(self) -> None:
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections.clear()
+        self._local = threading.local()
+
 
 class DataAccessLayer:
 
-    def __init__(self, db_client):
-        self.db = db_client.cursor()
+    def __init__(self, db_client: Union[sqlite3.Connection, ConnectionPool]):
+        """
+        :param db_client: a single connection (opened with check_same_thread=False if used from the optimizer
+            executor), or a ConnectionPool to use one connection per thread
+        """
+        self.db_client = db_client
 
-    def get_positions(self, as_of_date: datetime, portfolio: Optional[list] = None) -> pd.DataFrame:
+    def connection(self) -> sqlite3.Connection:
+        """
+        Return the connection for the calling thread
+        """
+        if isinstance(self.db_client, ConnectionPool):
+            return self.db_client.connection()
+        return self.db_client
+
+    @property
+    def data_version(self) -> int:
+        """
+        Version of the underlying data. It is stored in the database and incremented by every load, so a reload by
+        any process discards the cached optimization inputs of every worker
+        """
+        return read_data_version(self.connection())
+
+    def notify_data_reload(self) -> None:
+        """
+        Signal that the underlying tables were changed without load_dataframes or the setters below
+        """
+        connection = self.connection()
+        with connection:
+            bump_data_version(connection)
+
+    def get_data_loads(self, tables: list) -> dict:
+        """
+        Return the fingerprint and load time of the last load of each of tables
+        :param tables:
+        :return: {table_name: [fingerprint, loaded_at]}
+        """
+        return get_data_loads(self.connection(), tables)
+
+    def get_positions(self, as_of_date: datetime, portfolio: Optional[list] = None,
+                      security_id: Optional[list] = None, columns: Optional[list] = None) -> pd.DataFrame:
         """
         Return the positions
         :param as_of_date:
         :param portfolio: [Optional] list of portfolios
+        :param security_id: [Optional] list of securities
+        :param columns: [Optional] columns to return, all columns if not provided
         :return: dataframe with position data
         """
+        conditions = ["as_of_date = ?"]
+        params = [as_of_date.strftime('%Y-%m-%d')]
+
         if portfolio:
-            portfolio_filter = " AND portfolio IN ({})".format(','.join(['?' for _ in portfolio]))
-            params = [as_of_date.strftime('%Y-%m-%d')] + portfolio
-        else:
-            portfolio_filter = ""
-            params = [as_of_date.strftime('%Y-%m-%d')]
-            
-        query = f"SELECT * FROM positions WHERE as_of_date = ?{portfolio_filter}"
-        return pd.read_sql(query, self.db.connection, params=params)
+            conditions.append("portfolio IN ({})".format(','.join(['?' for _ in portfolio])))
+            params.extend(portfolio)
+
+        return self._select('positions', columns, conditions, params, security_id)
 
     def get_security_pb_coefficients(self, as_of_date: datetime, portfolio: Optional[list] = None,
-                                     security_id: Optional[list] = None) -> pd.DataFrame:
+                                     security_id: Optional[list] = None, columns: Optional[list] = None) -> pd.DataFrame:
         """
         Return the portfolio coefficients
         :param as_of_date:
         :param portfolio:
         :param security_id:
+        :param columns: [Optional] columns to return, all columns if not provided
         :return:
         """
         conditions = ["as_of_date = ?"]
@@ -40,13 +130,61 @@ class DataAccessLayer:
         if portfolio:
             conditions.append("portfolio IN ({})".format(','.join(['?' for _ in portfolio])))
             params.extend(portfolio)
-            
-        if security_id:
-            conditions.append("security_id IN ({})".format(','.join(['?' for _ in security_id])))
-            params.extend(security_id)
-            
-        query = f"SELECT * FROM pb_coefficients WHERE {' AND '.join(conditions)}"
-        return pd.read_sql(query, self.db.connection, params=params)
+
+        return self._select('pb_coefficients', columns, conditions, params, security_id)
+
+    def get_pb_position_totals(self, as_of_date: datetime) -> pd.DataFrame:
+        """
+        Return the market value of the positions held with each counterparty
+        :param as_of_date:
+        :return: dataframe with counterparty and market_value columns
+        """
+        query = """SELECT counterparty, SUM(market_value) AS market_value FROM positions WHERE as_of_date = ?
+                   GROUP BY counterparty"""
+        return pd.read_sql(query, self.connection(), params=[as_of_date.strftime('%Y-%m-%d')])
+
+    def iter_positions(self, as_of_date: datetime, portfolio: Optional[list] = None,
+                       security_id: Optional[list] = None, columns: Optional[list] = None,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """
+        get_positions in dataframes of at most chunk_size rows read from the cursor as they are consumed
+        """
+        conditions = ["as_of_date = ?"]
+        params = [as_of_date.strftime('%Y-%m-%d')]
+
+        if portfolio:
+            conditions.append("portfolio IN ({})".format(','.join(['?' for _ in portfolio])))
+            params.extend(portfolio)
+
+        return self._select_chunks('positions', columns, conditions, params, security_id, chunk_size)
+
+    def iter_security_pb_coefficients(self, as_of_date: datetime, security_id: Optional[list] = None,
+                                      columns: Optional[list] = None,
+                                      chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """
+        get_security_pb_coefficients in dataframes of at most chunk_size rows read from the cursor as they are consumed
+        """
+        conditions = ["as_of_date = ?"]
+        params = [as_of_date.strftime('%Y-%m-%d')]
+        return self._select_chunks('pb_coefficients', columns, conditions, params, security_id, chunk_size)
+
+    def get_coefficient_statistics(self, as_of_date: datetime) -> pd.DataFrame:
+        """
+        Return the min and max coefficient by counterparty and metric used to normalize coefficients. Uses the
+        precomputed pb_coefficient_stats table and falls back to aggregating pb_coefficients if the date is missing
+        :param as_of_date:
+        :return: dataframe with counterparty, metric_name, min_val and max_val columns
+        """
+        params = [as_of_date.strftime('%Y-%m-%d')]
+        query = """SELECT counterparty, metric_name, min_val, max_val FROM pb_coefficient_stats
+                   WHERE as_of_date = ? ORDER BY counterparty, metric_name"""
+        statistics = pd.read_sql(query, self.connection(), params=params)
+        if statistics.empty:
+            query = """SELECT counterparty, metric_name, MIN(coefficient_value) AS min_val,
+                       MAX(coefficient_value) AS max_val FROM pb_coefficients WHERE as_of_date = ?
+                       GROUP BY counterparty, metric_name ORDER BY counterparty, metric_name"""
+            statistics = pd.read_sql(query, self.connection(), params=params)
+        return statistics
 
     def get_optimization_priorities(self) -> pd.DataFrame:
         """
@@ -54,7 +192,7 @@ class DataAccessLayer:
         :return: dataframe with metric priorities
         """
         query = "SELECT * FROM optimization_priorities"
-        return pd.read_sql(query, self.db.connection)
+        return pd.read_sql(query, self.connection())
 
     def set_optimization_priorities(self, priorities_df: pd.DataFrame) -> None:
         """
@@ -62,6 +200,76 @@ class DataAccessLayer:
         :param priorities_df: dataframe with metric_name and weight columns
         """
         # Clear existing priorities and insert new ones
-        self.db.execute("DELETE FROM optimization_priorities")
-        priorities_df.to_sql('optimization_priorities', self.db.connection, if_exists='append', index=False)
-        self.db.connection.commit()
\ No newline at end of file
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM optimization_priorities")
+            priorities_df.to_sql('optimization_priorities', connection, if_exists='append', index=False)
+            bump_data_version(connection)
+
+    def get_allocation_constraints(self) -> pd.DataFrame:
+        """
+        Get the allocation constraints
+        :return: dataframe with constraint_type, counterparty, security_id, min_value and max_value columns
+        """
+        query = """SELECT constraint_type, counterparty, security_id, min_value, max_value
+                   FROM allocation_constraints ORDER BY constraint_id"""
+        constraints = pd.read_sql(query, self.connection())
+        # Only security limits have a security_id, keep the ids as integers next to the missing values
+        constraints['security_id'] = constraints['security_id'].astype('Int64')
+        return constraints
+
+    def set_allocation_constraints(self, constraints_df: pd.DataFrame) -> None:
+        """
+        Replace the allocation constraints
+        :param constraints_df: dataframe with constraint_type, counterparty, security_id, min_value and max_value
+            columns
+        :raises ValueError: if a constraint is invalid
+        """
+        validate_constraints(constraints_df)
+        connection = self.connection()
+        with connection:
+            connection.execute("DELETE FROM allocation_constraints")
+            constraints_df.to_sql('allocation_constraints', connection, if_exists='append', index=False)
+            bump_data_version(connection)
+
+    def _select(self, table: str, columns: Optional[list], conditions: list, params: list,
+                security_id: Optional[list] = None) -> pd.DataFrame:
+        """
+        Run a select on table, splitting large security_id filters in chunks to stay below SQLite's parameter limit
+        """
+        chunks = [pd.read_sql(query, self.connection(), params=query_params)
+                  for query, query_params in self._queries(table, columns, conditions, params, security_id)]
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+
+    def _select_chunks(self, table: str, columns: Optional[list], conditions: list, params: list,
+                       security_id: Optional[list] = None,
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+        """
+        Generator version of _select. A stream can be consumed from several threads, so with a ConnectionPool it
+        reads from its own connection, closed when the stream ends
+        """
+        dedicated = isinstance(self.db_client, ConnectionPool)
+        connection = self.db_client.connect() if dedicated else self.db_client
+        try:
+            for query, query_params in self._queries(table, columns, conditions, params, security_id):
+                yield from pd.read_sql(query, connection, params=query_params, chunksize=chunk_size)
+        finally:
+            if dedicated:
+                connection.close()
+
+    @staticmethod
+    def _queries(table: str, columns: Optional[list], conditions: list, params: list,
+                 security_id: Optional[list] = None) -> Iterator[tuple]:
+        """
+        Yield the queries and parameters of a select on table, one by chunk of security_id
+        """
+        select = ', '.join(columns) if columns else '*'
+        query = f"SELECT {select} FROM {table} WHERE {' AND '.join(conditions)}"
+        if security_id is None or len(security_id) == 0:
+            yield query, params
+            return
+
+        security_id = [int(sec_id) for sec_id in security_id]
+        for start in range(0, len(security_id), MAX_QUERY_PARAMETERS):
+            chunk = security_id[start:start + MAX_QUERY_PARAMETERS]
+            yield query + " AND security_id IN ({})".format(','.join(['?' for _ in chunk])), params + chunk
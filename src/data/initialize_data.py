@@ -1,73 +1,339 @@
-
+import argparse
+import hashlib
 import sqlite3
 import pandas as pd
 import os
+from datetime import datetime
+from src.constraints import CONSTRAINT_COLUMNS, validate_constraints
 
-def initialize_mock_data(db_conn: sqlite3.Connection):
-    cursor = db_conn.cursor()
-    
-    # Create tables if they don't exist
-    cursor.execute("""
+# Stored in PRAGMA user_version, bump when the table definitions below change
+SCHEMA_VERSION = 4
+
+TABLES = {
+    'positions': """
         CREATE TABLE IF NOT EXISTS positions (
-            as_of_date TEXT,
-            portfolio TEXT,
-            security_id INTEGER,
+            as_of_date TEXT NOT NULL,
+            portfolio TEXT NOT NULL,
+            counterparty TEXT NOT NULL,
+            security_id INTEGER NOT NULL,
             quantity REAL,
-            market_value REAL
+            market_value REAL,
+            PRIMARY KEY (as_of_date, portfolio, counterparty, security_id)
         )
-    """)
-    
-    cursor.execute("""
+    """,
+    # The primary key index also serves (as_of_date, counterparty, security_id) lookups
+    'pb_coefficients': """
         CREATE TABLE IF NOT EXISTS pb_coefficients (
-            as_of_date TEXT,
-            portfolio TEXT,
-            security_id INTEGER,
-            coefficient REAL
+            as_of_date TEXT NOT NULL,
+            counterparty TEXT NOT NULL,
+            security_id INTEGER NOT NULL,
+            metric_name TEXT NOT NULL,
+            coefficient_value REAL,
+            PRIMARY KEY (as_of_date, counterparty, security_id, metric_name)
+        )
+    """,
+    'pb_coefficient_stats': """
+        CREATE TABLE IF NOT EXISTS pb_coefficient_stats (
+            as_of_date TEXT NOT NULL,
+            counterparty TEXT NOT NULL,
+            metric_name TEXT NOT NULL,
+            min_val REAL,
+            max_val REAL,
+            PRIMARY KEY (as_of_date, counterparty, metric_name)
         )
-    """)
-    
-    cursor.execute("""
+    """,
+    'optimization_priorities': """
         CREATE TABLE IF NOT EXISTS optimization_priorities (
             metric_name TEXT PRIMARY KEY,
             weight REAL
         )
-    """)
-    
-    # Read positions CSV
-    positions_path = os.path.join(os.path.dirname(__file__), 'positions.csv')
-    if os.path.exists(positions_path):
-        positions_df = pd.read_csv(positions_path)
-        # Insert positions data into database
-        positions_df.to_sql('positions', db_conn, if_exists='replace', index=False)
-        print(f"Loaded {len(positions_df)} position records")
-    else:
-        print("positions.csv not found")
-    
-    # Read security coefficients CSV
-    coefficients_path = os.path.join(os.path.dirname(__file__), 'security_coefficients.csv')
-    if os.path.exists(coefficients_path):
-        coefficients_df = pd.read_csv(coefficients_path)
-        # Insert coefficients data into database
-        coefficients_df.to_sql('pb_coefficients', db_conn, if_exists='replace', index=False)
-        print(f"Loaded {len(coefficients_df)} coefficient records")
-    else:
-        print("security_coefficients.csv not found")
-    
-    # Read optimization priorities CSV
-    priorities_path = os.path.join(os.path.dirname(__file__), 'optimization_priorities.csv')
-    if os.path.exists(priorities_path):
-        priorities_df = pd.read_csv(priorities_path)
-        # Insert priorities data into database
-        priorities_df.to_sql('optimization_priorities', db_conn, if_exists='replace', index=False)
-        print(f"Loaded {len(priorities_df)} optimization priority records")
-    else:
-        print("optimization_priorities.csv not found")
-    
-    db_conn.commit()
+    """,
+    # Declarative allocation constraints, see src.constraints for the constraint types
+    'allocation_constraints': """
+        CREATE TABLE IF NOT EXISTS allocation_constraints (
+            constraint_id INTEGER PRIMARY KEY,
+            constraint_type TEXT NOT NULL,
+            counterparty TEXT NOT NULL,
+            security_id INTEGER,
+            min_value REAL,
+            max_value REAL
+        )
+    """,
+    # Fingerprint of the last file loaded in each table, so loading the same files again is skipped
+    'data_loads': """
+        CREATE TABLE IF NOT EXISTS data_loads (
+            table_name TEXT PRIMARY KEY,
+            fingerprint TEXT NOT NULL,
+            loaded_at TEXT NOT NULL
+        )
+    """,
+    # Single row incremented by every load, workers compare it to discard their cached optimization inputs
+    'data_version': """
+        CREATE TABLE IF NOT EXISTS data_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """,
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_positions_date_pb_security ON positions (as_of_date, counterparty, security_id)",
+    "CREATE INDEX IF NOT EXISTS idx_positions_date_security ON positions (as_of_date, security_id)",
+    "CREATE INDEX IF NOT EXISTS idx_pb_coefficients_date_security ON pb_coefficients (as_of_date, security_id)",
+]
+
+POSITION_COLUMNS = ['as_of_date', 'portfolio', 'counterparty', 'security_id', 'quantity', 'market_value']
+COEFFICIENT_COLUMNS = ['as_of_date', 'counterparty', 'security_id', 'metric_name', 'coefficient_value']
+PRIORITY_COLUMNS = ['metric_name', 'weight']
+
+DATA_DIR = os.path.dirname(__file__)
+
+
+def create_schema(db_conn: sqlite3.Connection):
+    """
+    Create tables and indexes, migrating tables created by older versions (without keys or indexes) and enabling WAL
+    :param db_conn:
+    """
+    db_conn.execute("PRAGMA journal_mode=WAL")
+    db_conn.execute("PRAGMA synchronous=NORMAL")
+    version = schema_version(db_conn)
+    with db_conn:
+        for table, create_statement in TABLES.items():
+            if version < SCHEMA_VERSION:
+                _migrate_table(db_conn, table, create_statement)
+            else:
+                db_conn.execute(create_statement)
+        for create_index in INDEXES:
+            db_conn.execute(create_index)
+        db_conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+
+def schema_version(db_conn: sqlite3.Connection) -> int:
+    """
+    Return the schema version of the database, SCHEMA_VERSION once create_schema has run on it
+    """
+    return db_conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def read_data_version(db_conn: sqlite3.Connection) -> int:
+    """
+    Return the version of the data, 0 if nothing was loaded since the data_version table was created
+    """
+    try:
+        row = db_conn.execute("SELECT version FROM data_version WHERE id = 1").fetchone()
+    except sqlite3.OperationalError:
+        # Database created by an older schema version
+        return 0
+    return row[0] if row else 0
+
+
+def bump_data_version(db_conn: sqlite3.Connection) -> None:
+    """
+    Increment the version of the data, call it in the transaction that changes the data
+    """
+    db_conn.execute("INSERT INTO data_version (id, version) VALUES (1, 1) "
+                    "ON CONFLICT (id) DO UPDATE SET version = version + 1")
+
+
+def get_data_loads(db_conn: sqlite3.Connection, tables: list) -> dict:
+    """
+    Return the fingerprint and load time of the last load of each of tables, tables never loaded are left out
+    :return: {table_name: [fingerprint, loaded_at]}
+    """
+    query = "SELECT table_name, fingerprint, loaded_at FROM data_loads WHERE table_name IN ({})".format(
+        ','.join(['?' for _ in tables]))
+    return {table: [fingerprint, loaded_at] for table, fingerprint, loaded_at in db_conn.execute(query, tables)}
+
+
+def _migrate_table(db_conn: sqlite3.Connection, table: str, create_statement: str):
+    """
+    Recreate table with the current definition, copying the columns it shares with the existing table
+    """
+    existing_columns = [row[1] for row in db_conn.execute(f"PRAGMA table_info({table})")]
+    if not existing_columns:
+        db_conn.execute(create_statement)
+        return
+    db_conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+    db_conn.execute(create_statement)
+    new_columns = [row[1] for row in db_conn.execute(f"PRAGMA table_info({table})")]
+    columns = ', '.join(column for column in new_columns if column in existing_columns)
+    if columns:
+        db_conn.execute(f"INSERT OR REPLACE INTO {table} ({columns}) SELECT {columns} FROM {table}_legacy")
+    db_conn.execute(f"DROP TABLE {table}_legacy")
+
+
+def load_data_files(db_conn: sqlite3.Connection, positions_path: str = None, coefficients_path: str = None,
+                    priorities_path: str = None, constraints_path: str = None, fingerprints: dict = None) -> dict:
+    """
+    Load CSV files in a single transaction. Positions and coefficients replace the rows of the dates present in the
+    files and leave other dates untouched, priorities and constraints replace the whole table
+    :param db_conn:
+    :param positions_path: [Optional] CSV with POSITION_COLUMNS
+    :param coefficients_path: [Optional] CSV with COEFFICIENT_COLUMNS
+    :param priorities_path: [Optional] CSV with PRIORITY_COLUMNS
+    :param constraints_path: [Optional] CSV with CONSTRAINT_COLUMNS
+    :param fingerprints: [Optional] fingerprint of the file loaded in each table, recorded in data_loads
+    :return: number of records loaded by table
+    """
+    positions_df = pd.read_csv(positions_path) if positions_path else None
+    coefficients_df = pd.read_csv(coefficients_path) if coefficients_path else None
+    priorities_df = pd.read_csv(priorities_path) if priorities_path else None
+    constraints_df = pd.read_csv(constraints_path) if constraints_path else None
+    return load_dataframes(db_conn, positions_df, coefficients_df, priorities_df, constraints_df, fingerprints)
+
+
+def load_dataframes(db_conn: sqlite3.Connection, positions_df: pd.DataFrame = None,
+                    coefficients_df: pd.DataFrame = None, priorities_df: pd.DataFrame = None,
+                    constraints_df: pd.DataFrame = None, fingerprints: dict = None) -> dict:
+    """
+    Load dataframes in a single transaction, with the same semantics as load_data_files. Each loaded table is
+    recorded in data_loads and the data version is incremented in the same transaction
+    :param db_conn:
+    :param positions_df: [Optional] dataframe with POSITION_COLUMNS
+    :param coefficients_df: [Optional] dataframe with COEFFICIENT_COLUMNS
+    :param priorities_df: [Optional] dataframe with PRIORITY_COLUMNS
+    :param constraints_df: [Optional] dataframe with CONSTRAINT_COLUMNS
+    :param fingerprints: [Optional] fingerprint of the data loaded in each table, empty for tables not listed
+    :return: number of records loaded by table
+    :raises ValueError: if a constraint is invalid, nothing is loaded then
+    """
+    if constraints_df is not None:
+        constraints_df = constraints_df.reindex(columns=CONSTRAINT_COLUMNS)
+        validate_constraints(constraints_df)
+    loaded = {}
+    with db_conn:
+        if positions_df is not None:
+            loaded['positions'] = _replace_dates(db_conn, 'positions', positions_df, POSITION_COLUMNS)
+        if coefficients_df is not None:
+            loaded['pb_coefficients'] = _replace_dates(db_conn, 'pb_coefficients', coefficients_df,
+                                                       COEFFICIENT_COLUMNS)
+            refresh_coefficient_statistics(db_conn, coefficients_df['as_of_date'].unique().tolist())
+        if priorities_df is not None:
+            db_conn.execute("DELETE FROM optimization_priorities")
+            loaded['optimization_priorities'] = _insert(db_conn, 'optimization_priorities', priorities_df,
+                                                        PRIORITY_COLUMNS)
+        if constraints_df is not None:
+            db_conn.execute("DELETE FROM allocation_constraints")
+            loaded['allocation_constraints'] = _insert(db_conn, 'allocation_constraints', constraints_df,
+                                                       CONSTRAINT_COLUMNS)
+        if loaded:
+            # Tables loaded without a fingerprint are still told apart by loaded_at
+            fingerprints = fingerprints or {}
+            loaded_at = datetime.now().isoformat()
+            db_conn.executemany("INSERT OR REPLACE INTO data_loads (table_name, fingerprint, loaded_at) "
+                                "VALUES (?, ?, ?)", [(table, fingerprints.get(table, ''), loaded_at) for table in loaded])
+            bump_data_version(db_conn)
+    return loaded
+
+
+def _replace_dates(db_conn: sqlite3.Connection, table: str, df: pd.DataFrame, columns: list) -> int:
+    dates = df['as_of_date'].unique().tolist()
+    db_conn.execute(f"DELETE FROM {table} WHERE as_of_date IN ({','.join(['?' for _ in dates])})", dates)
+    return _insert(db_conn, table, df, columns)
+
+
+def _insert(db_conn: sqlite3.Connection, table: str, df: pd.DataFrame, columns: list) -> int:
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['?' for _ in columns])})"
+    db_conn.executemany(query, df[columns].itertuples(index=False, name=None))
+    return len(df)
+
+
+# Table loaded by each argument of load_data_files
+DATA_FILE_TABLES = {
+    'positions_path': 'positions',
+    'coefficients_path': 'pb_coefficients',
+    'priorities_path': 'optimization_priorities',
+    'constraints_path': 'allocation_constraints',
+}
+
+
+def initialize_database(db_conn: sqlite3.Connection, force: bool = False, **paths) -> dict:
+    """
+    Create or migrate the schema and load the data files that differ from the last file loaded in their table. Safe
+    to run on every deployment: a database already at the schema version with the same files loaded is left as is
+    :param db_conn:
+    :param force: load the files even if they were already loaded
+    :param paths: arguments of load_data_files
+    :return: number of records loaded by table, tables whose file was already loaded are not included
+    """
+    create_schema(db_conn)
+    fingerprints = {key: _file_fingerprint(path) for key, path in paths.items() if path}
+    loaded_fingerprints = dict(db_conn.execute("SELECT table_name, fingerprint FROM data_loads").fetchall())
+    changed = {key: paths[key] for key, fingerprint in fingerprints.items()
+               if force or loaded_fingerprints.get(DATA_FILE_TABLES[key]) != fingerprint}
+    if not changed:
+        return {}
+
+    return load_data_files(db_conn, **changed,
+                           fingerprints={DATA_FILE_TABLES[key]: fingerprints[key] for key in changed})
+
+
+def _file_fingerprint(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def initialize_mock_data(db_conn: sqlite3.Connection, force: bool = False):
+    """
+    Load the sample CSV files next to this module, skipping the files that are already loaded
+    :param db_conn:
+    :param force: reload the files even if they are already loaded
+    """
+    paths = {}
+    for key, file_name in [('positions_path', 'positions.csv'), ('coefficients_path', 'security_coefficients.csv'),
+                           ('priorities_path', 'optimization_priorities.csv')]:
+        path = os.path.join(DATA_DIR, file_name)
+        if os.path.exists(path):
+            paths[key] = path
+        else:
+            print(f"{file_name} not found")
+
+    loaded = initialize_database(db_conn, force, **paths)
+    for table, records in loaded.items():
+        print(f"Loaded {records} {table} records")
+    if not loaded:
+        print(f"Database is at schema version {SCHEMA_VERSION} with the data files already loaded, nothing to do")
     print("Database initialization completed")
 
+def refresh_coefficient_statistics(db_conn: sqlite3.Connection, as_of_dates: list = None):
+    """
+    Recompute the min and max coefficient by counterparty and metric used to normalize coefficients
+    :param db_conn:
+    :param as_of_dates: [Optional] dates to refresh, all dates if not provided
+    """
+    date_filter = " WHERE as_of_date IN ({})".format(','.join(['?' for _ in as_of_dates])) if as_of_dates else ""
+    params = as_of_dates or []
+    cursor = db_conn.cursor()
+    cursor.execute(f"DELETE FROM pb_coefficient_stats{date_filter}", params)
+    cursor.execute(f"""
+        INSERT INTO pb_coefficient_stats (as_of_date, counterparty, metric_name, min_val, max_val)
+        SELECT as_of_date, counterparty, metric_name, MIN(coefficient_value), MAX(coefficient_value)
+        FROM pb_coefficients{date_filter}
+        GROUP BY as_of_date, counterparty, metric_name
+    """, params)
+
 if __name__ == "__main__":
-    # For testing purposes
-    db_conn = sqlite3.connect("test_portfolio.db")
-    initialize_mock_data(db_conn)
+    parser = argparse.ArgumentParser(description="Create or migrate the database and load positions, coefficients, "
+                                                 "priorities and constraints CSV files (the sample files if none "
+                                                 "are given). Files already loaded are skipped")
+    parser.add_argument('--db', default=os.environ.get('PB_OPTIMIZER_DB', 'portfolio.db'),
+                        help="SQLite database file")
+    parser.add_argument('--positions', help="positions CSV, replaces the dates it contains")
+    parser.add_argument('--coefficients', help="security coefficients CSV, replaces the dates it contains")
+    parser.add_argument('--priorities', help="optimization priorities CSV, replaces all priorities")
+    parser.add_argument('--constraints', help="allocation constraints CSV, replaces all constraints")
+    parser.add_argument('--force', action='store_true', help="load the files even if they were already loaded")
+    args = parser.parse_args()
+
+    db_conn = sqlite3.connect(args.db)
+    if args.positions or args.coefficients or args.priorities or args.constraints:
+        print(initialize_database(db_conn, args.force, positions_path=args.positions,
+                                  coefficients_path=args.coefficients, priorities_path=args.priorities,
+                                  constraints_path=args.constraints))
+    else:
+        # For testing purposes
+        initialize_mock_data(db_conn, args.force)
     db_conn.close()
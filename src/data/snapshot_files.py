@@ -0,0 +1,120 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from datetime import datetime
+from typing import Optional
+from src.snapshot_cache import OptimizationSnapshot
+
+# Bump when the files written by export_snapshot change
+SNAPSHOT_FORMAT_VERSION = 2
+# Tables a snapshot is built from, the files are stale once one of them is loaded again
+SNAPSHOT_TABLES = ['positions', 'pb_coefficients']
+
+# One .npy file per array. The PB and metric axes are the dictionaries of the codes used by the matrix axes
+ARRAYS = {
+    'pb_codes': 'pb_codes.npy',
+    'metric_names': 'metric_names.npy',
+    'security_ids': 'security_ids.npy',
+    'positions_matrix': 'positions.npy',
+    'coefficients_matrix': 'coefficients.npy',
+}
+METADATA_FILE = 'snapshot.json'
+
+
+def snapshot_path(directory: str, as_of_date: datetime) -> str:
+    return os.path.join(directory, as_of_date.strftime('%Y-%m-%d'))
+
+
+def export_snapshot(snapshot: OptimizationSnapshot, directory: str, data_loads: Optional[dict] = None) -> str:
+    """
+    Write the normalized optimization inputs of a complete snapshot to directory/<as_of_date>/ as .npy files. The
+    files of the date are replaced at once, processes that have the previous files mapped keep reading them
+    :param snapshot: snapshot with every security of the date
+    :param directory:
+    :param data_loads: [Optional] data_loads of SNAPSHOT_TABLES read before the snapshot was built, load_snapshot
+        ignores the files once they changed
+    :return: path of the date's directory
+    """
+    if not snapshot.complete:
+        raise ValueError("Only snapshots with every security of the date can be exported")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, snapshot.as_of_date)
+    staging = tempfile.mkdtemp(prefix=f'.{snapshot.as_of_date}-', dir=directory)
+    try:
+        arrays = {'pb_codes': np.asarray(snapshot.pb_codes).astype(str),
+                  'metric_names': np.asarray(snapshot.metric_names).astype(str),
+                  'security_ids': snapshot.security_index.to_numpy(dtype=np.int64),
+                  'positions_matrix': np.ascontiguousarray(snapshot.positions_matrix, dtype=float),
+                  'coefficients_matrix': np.ascontiguousarray(snapshot.coefficients_matrix, dtype=float)}
+        for name, file_name in ARRAYS.items():
+            np.save(os.path.join(staging, file_name), arrays[name], allow_pickle=False)
+        metadata = {'format_version': SNAPSHOT_FORMAT_VERSION, 'as_of_date': snapshot.as_of_date,
+                    'missing_coefficient_value': snapshot.missing_coefficient_value,
+                    'shape': list(snapshot.coefficients_matrix.shape), 'data_loads': data_loads or {},
+                    'created_at': datetime.now().isoformat()}
+        with open(os.path.join(staging, METADATA_FILE), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(staging, path)
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return path
+
+
+def load_snapshot(directory: str, as_of_date: datetime, data_version: int = 0, mmap: bool = True,
+                  data_loads: Optional[dict] = None) -> Optional[OptimizationSnapshot]:
+    """
+    Open the snapshot files of as_of_date. With mmap the matrices are np.memmap views of the files, so loading is
+    immediate and every process reading the same date shares the page cache
+    :param directory:
+    :param as_of_date:
+    :param data_version: data version given to the snapshot
+    :param mmap: map the matrices instead of reading them in memory
+    :param data_loads: [Optional] current data_loads of SNAPSHOT_TABLES, files exported from other loads are stale
+    :return: the snapshot, or None if there are no files for as_of_date (or they have an older format or are stale)
+    """
+    path = snapshot_path(directory, as_of_date)
+    try:
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+    if metadata.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+        return None
+    if data_loads is not None and metadata['data_loads'] != data_loads:
+        return None
+
+    arrays = {name: np.load(os.path.join(path, file_name), mmap_mode='r' if mmap else None, allow_pickle=False)
+              for name, file_name in ARRAYS.items()}
+    return OptimizationSnapshot(as_of_date=metadata['as_of_date'], data_version=data_version,
+                                pb_codes=np.asarray(arrays['pb_codes']).astype(object),
+                                metric_names=np.asarray(arrays['metric_names']).astype(object),
+                                security_index=pd.Index(np.asarray(arrays['security_ids'])),
+                                positions_matrix=arrays['positions_matrix'],
+                                coefficients_matrix=arrays['coefficients_matrix'],
+                                missing_coefficient_value=metadata['missing_coefficient_value'], complete=True)
+
+
+if __name__ == "__main__":
+    from src.data.data_access_layer import DataAccessLayer, ConnectionPool
+    from src.pb_optimizer import PBOptimizer
+
+    parser = argparse.ArgumentParser(description="Export the optimization inputs of dates to memory mapped files")
+    parser.add_argument('--db', default='portfolio.db', help="SQLite database file")
+    parser.add_argument('--directory', required=True, help="directory the snapshot files are written to")
+    parser.add_argument('dates', nargs='+', help="dates to export, YYYY-MM-DD")
+    args = parser.parse_args()
+
+    optimizer = PBOptimizer(DataAccessLayer(ConnectionPool(args.db)))
+    for date in args.dates:
+        data_loads = optimizer.dao.get_data_loads(SNAPSHOT_TABLES)
+        snapshot = optimizer.build_snapshot(datetime.fromisoformat(date))
+        path = export_snapshot(snapshot, args.directory, data_loads)
+        print(f"Exported {len(snapshot.security_index)} securities to {path}")
+    optimizer.close()
@@ -0,0 +1,12 @@
+class OptimizerBusyError(Exception):
+    """
+    Raised when an allocation is requested while all solver workers and queue slots are taken
+    """
+    pass
+
+
+class InfeasibleAllocationError(ValueError):
+    """
+    Raised when no allocation satisfies the allocation constraints
+    """
+    pass
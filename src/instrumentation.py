@@ -0,0 +1,225 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+# Only one cProfile profiler runs at a time. From Python 3.12 cProfile is built on sys.monitoring, which allows a
+# single profiler per process (a second enable() raises ValueError) and records the calls of every thread, so a
+# profile also includes the work of the requests running next to the profiled one
+_PROFILE_LOCK = threading.Lock()
+
+
+class StageTimer:
+    """
+    Collects per-stage wall and CPU timings, problem dimensions and solver statistics of one allocation request
+    """
+
+    def __init__(self, profile: bool = False):
+        """
+        :param profile: run cProfile while profiling() is active and add the stats to the report
+        """
+        self.stages = {}
+        self.dimensions = {}
+        self.solver = {}
+        self.profile = profile
+        self.profile_stats = None
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the enclosed block. CPU time is the calling thread's, work done in other processes is not included
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = self.stages.get(name, (0.0, 0.0))
+            self.stages[name] = (wall + time.perf_counter() - wall_start, cpu + time.thread_time() - cpu_start)
+
+    def set_dimensions(self, **dimensions) -> None:
+        self.dimensions.update(dimensions)
+
+    def record_solver(self, result) -> None:
+        """
+        Add the statistics of a scipy OptimizeResult. Iterations and function evaluations are added up when several
+        problems are solved for one request
+        """
+        self.solver['solves'] = self.solver.get('solves', 0) + 1
+        for key, name in [('nit', 'iterations'), ('nfev', 'function_evaluations'), ('njev', 'gradient_evaluations')]:
+            value = result.get(key)
+            if value is not None:
+                self.solver[name] = self.solver.get(name, 0) + int(value)
+        if result.get('fun') is not None:
+            self.solver['objective'] = self.solver.get('objective', 0.0) + float(result.get('fun'))
+        self.solver['status'] = int(result.get('status', 0))
+        self.solver['success'] = bool(result.get('success', False))
+        self.solver['message'] = str(result.get('message', ''))
+
+    def add(self, other: Optional['StageTimer']) -> None:
+        """
+        Add the stage timings, dimensions and solver statistics of another timer, e.g. of a batch this request was
+        solved in
+        """
+        if other is None:
+            return
+        for name, (wall, cpu) in other.stages.items():
+            total_wall, total_cpu = self.stages.get(name, (0.0, 0.0))
+            self.stages[name] = (total_wall + wall, total_cpu + cpu)
+        self.dimensions.update(other.dimensions)
+        self.solver.update(other.solver)
+        if other.profile_stats is not None:
+            self.profile_stats = other.profile_stats
+
+    @contextmanager
+    def profiling(self, limit: int = 30):
+        """
+        Run cProfile while the block runs, if profile is enabled. Skipped with a note in the report if another
+        request is being profiled
+        :param limit: number of functions kept in the stats, by cumulative time
+        """
+        if not self.profile:
+            yield
+            return
+        if not _PROFILE_LOCK.acquire(blocking=False):
+            self.profile_stats = "Not profiled, another request was being profiled"
+            yield
+            return
+        try:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Another profiling tool outside of this module is active
+                self.profile_stats = f"Not profiled, {e}"
+                yield
+                return
+            try:
+                yield
+            finally:
+                profiler.disable()
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+                self.profile_stats = stream.getvalue()
+        finally:
+            _PROFILE_LOCK.release()
+
+    def report(self) -> dict:
+        report = {'stages': {name: {'wall_seconds': wall, 'cpu_seconds': cpu}
+                             for name, (wall, cpu) in self.stages.items()},
+                  'dimensions': dict(self.dimensions),
+                  'solver': dict(self.solver)}
+        if self.profile_stats is not None:
+            report['profile'] = self.profile_stats
+        return report
+
+
+class _NullTimer:
+    """
+    StageTimer that records nothing, used when instrumentation is disabled
+    """
+    profile = False
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def set_dimensions(self, **dimensions) -> None:
+        pass
+
+    def record_solver(self, result) -> None:
+        pass
+
+    def add(self, other) -> None:
+        pass
+
+    def profiling(self, limit: int = 30):
+        return nullcontext()
+
+
+NULL_TIMER = _NullTimer()
+
+
+class MetricsRegistry:
+    """
+    Thread safe aggregation of StageTimer reports, rendered in the Prometheus text exposition format
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, prefix: str = 'pb_optimizer'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._stage_wall = {}
+        self._stage_cpu = {}
+        self._requests = {}
+        self._solver = {}
+        self._dimensions = {}
+
+    def observe(self, report: dict, endpoint: str, status: str = 'success') -> None:
+        """
+        Add a StageTimer report
+        :param report:
+        :param endpoint: name of the operation, used as a label
+        :param status: 'success' or 'error'
+        """
+        with self._lock:
+            key = (endpoint, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for name, timing in report.get('stages', {}).items():
+                self._observe_histogram(name, timing['wall_seconds'])
+                self._stage_cpu[name] = self._stage_cpu.get(name, 0.0) + timing['cpu_seconds']
+            for name, value in report.get('solver', {}).items():
+                if name in ('solves', 'iterations', 'function_evaluations', 'gradient_evaluations'):
+                    self._solver[name] = self._solver.get(name, 0) + value
+            for name, value in report.get('dimensions', {}).items():
+                total, count = self._dimensions.get(name, (0, 0))
+                self._dimensions[name] = (total + value, count + 1)
+
+    def _observe_histogram(self, name: str, value: float) -> None:
+        buckets = self._stage_wall.setdefault(name, [[0] * len(self.BUCKETS), 0.0, 0])
+        for i, bound in enumerate(self.BUCKETS):
+            if value <= bound:
+                buckets[0][i] += 1
+        buckets[1] += value
+        buckets[2] += 1
+
+    def render(self, gauges: dict = None) -> str:
+        """
+        Return the metrics in the Prometheus text format
+        :param gauges: [Optional] extra gauge values by name, e.g. snapshot cache statistics
+        :return:
+        """
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines += [f"# HELP {p}_requests_total Allocation requests by endpoint and status",
+                      f"# TYPE {p}_requests_total counter"]
+            for (endpoint, status), count in sorted(self._requests.items()):
+                lines.append(f'{p}_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+            lines += [f"# HELP {p}_stage_seconds Wall time by allocation stage",
+                      f"# TYPE {p}_stage_seconds histogram"]
+            for name, (counts, total, count) in sorted(self._stage_wall.items()):
+                for bound, bucket_count in zip(self.BUCKETS, counts):
+                    lines.append(f'{p}_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {bucket_count}')
+                lines.append(f'{p}_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {count}')
+                lines.append(f'{p}_stage_seconds_sum{{stage="{name}"}} {total}')
+                lines.append(f'{p}_stage_seconds_count{{stage="{name}"}} {count}')
+
+            lines += [f"# HELP {p}_stage_cpu_seconds_total CPU time by allocation stage",
+                      f"# TYPE {p}_stage_cpu_seconds_total counter"]
+            for name, total in sorted(self._stage_cpu.items()):
+                lines.append(f'{p}_stage_cpu_seconds_total{{stage="{name}"}} {total}')
+
+            for name, total in sorted(self._solver.items()):
+                lines += [f"# TYPE {p}_solver_{name}_total counter", f"{p}_solver_{name}_total {total}"]
+
+            for name, (total, count) in sorted(self._dimensions.items()):
+                lines += [f"# TYPE {p}_problem_{name} summary",
+                          f"{p}_problem_{name}_sum {total}", f"{p}_problem_{name}_count {count}"]
+
+        for name, value in sorted((gauges or {}).items()):
+            lines += [f"# TYPE {p}_{name} gauge", f"{p}_{name} {value}"]
+        return '\n'.join(lines) + '\n'
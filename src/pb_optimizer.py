@@ -1,121 +1,797 @@
 import asyncio
+import logging
+import multiprocessing
+import os
 import sqlite3
+import threading
 import numpy as np
 import pandas as pd
-from scipy.optimize import minimize
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
-from src.data.data_access_layer import DataAccessLayer
+from typing import Optional, Union
+from src.allocation_store import AllocationStore, PriorAllocation
+from src.constraints import LinearConstraints, compile_constraints
+from src.data.data_access_layer import DataAccessLayer, ConnectionPool
 from src.data.initialize_data import initialize_mock_data
+from src.data.snapshot_files import SNAPSHOT_TABLES, load_snapshot
+from src.errors import OptimizerBusyError
+from src.instrumentation import StageTimer, NULL_TIMER
+from src.snapshot_cache import SnapshotCache, OptimizationSnapshot
+from src.solvers import solve_allocation, solve_decomposed, solve_scenarios
+from src.trade import AllocationResult, ScenarioResult
+
+logger = logging.getLogger(__name__)
 
 
 class PBOptimizer:
 
-    def __init__(self, data_access_layer: DataAccessLayer):
+    def __init__(self, data_access_layer: DataAccessLayer, snapshot_cache: Optional[SnapshotCache] = None,
+                 missing_coefficient_value: float = 1.0, max_workers: int = 4, max_queued: int = 16,
+                 max_processes: Optional[int] = None, process_pool_threshold: int = 500_000,
+                 allocation_store: Optional[AllocationStore] = None, snapshot_directory: Optional[str] = None,
+                 batch_window: float = 0.0):
+        """
+        :param data_access_layer:
+        :param snapshot_cache: [Optional] cache of per-date optimization inputs
+        :param missing_coefficient_value: normalized coefficient used when a PB has no coefficient for a security.
+            Defaults to the worst normalized value so missing data never makes a PB more attractive
+        :param max_workers: number of allocations solved concurrently
+        :param max_queued: number of allocations waiting for a worker before new ones are rejected
+        :param max_processes: [Optional] size of the process pool used for large batches, defaults to the CPU count
+        :param process_pool_threshold: number of allocation variables in a batch above which the baskets are solved
+            in the process pool
+        :param allocation_store: [Optional] allocations kept by id for incremental re-allocation
+        :param snapshot_directory: [Optional] directory of snapshot files written by src.data.snapshot_files. Dates
+            found there are memory mapped instead of loaded from the database
+        :param batch_window: seconds allocate_trade_list waits for other trade lists of the same date and solver to
+            solve them together in one problem. 0 solves every trade list on its own
+        """
         self.dao = data_access_layer
+        self.snapshot_cache = snapshot_cache if snapshot_cache is not None else SnapshotCache()
+        self.allocation_store = allocation_store if allocation_store is not None else AllocationStore()
+        self.snapshot_directory = snapshot_directory
+        self.missing_coefficient_value = missing_coefficient_value
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pb_optimizer')
+        self._capacity = threading.BoundedSemaphore(max_workers + max_queued)
+        self.max_processes = max_processes or os.cpu_count()
+        self.process_pool_threshold = process_pool_threshold
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        # Snapshot loads in progress by date, concurrent requests for the date wait for the load instead of repeating it
+        self._loads = {}
+        self._waiting = {}
+        self._loads_lock = threading.Lock()
+        self.batch_window = batch_window
+        # Trade lists waiting for the batch window to close, by (date, solver). Only used from the event loop
+        self._pending_batches = {}
+        # The event loop only keeps weak references to tasks, batches being solved are kept here until they are done
+        self._batch_tasks = set()
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        """
+        Process pool for CPU bound solves, created on first use. Workers are spawned rather than forked because the
+        optimizer runs alongside threads
+        """
+        with self._process_pool_lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.max_processes,
+                                                         mp_context=multiprocessing.get_context('spawn'))
+            return self._process_pool
+
+    def close(self) -> None:
+        """
+        Shut down the optimizer executors
+        """
+        self.executor.shutdown(wait=True)
+        with self._process_pool_lock:
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=True)
+                self._process_pool = None
 
-    async def allocate_trade_list(self, as_of_date: datetime, trade_list: pd.DataFrame) -> pd.DataFrame:
+    async def allocate_trade_list(self, as_of_date: datetime, trade_list: pd.DataFrame, solver: str = 'lp',
+                                  decompose: bool = False, timer: Optional[StageTimer] = None,
+                                  allocation_id: Optional[str] = None,
+                                  prior_allocation: Union[str, pd.DataFrame, PriorAllocation, None] = None
+                                  ) -> pd.DataFrame:
         """
-        Return an array with the allocation of the trade_list by PB
+        Return an array with the allocation of the trade_list by PB. The data loading and solve run in the optimizer
+        executor so the event loop is not blocked
         :param as_of_date:
         :param trade_list:
+        :param solver: 'lp' (HiGHS), 'exact' (closed form) or 'slsqp'
+        :param decompose: split the securities in blocks solved concurrently in the process pool
+        :param timer: [Optional] collects stage timings, problem dimensions and solver statistics
+        :param allocation_id: [Optional] keep the allocation in the allocation store under this id so an amended
+            trade list can be re-allocated incrementally
+        :param prior_allocation: [Optional] allocation of an earlier version of the trade list: an id in the
+            allocation store, the allocations returned for it or a PriorAllocation. Securities traded for the same
+            market value keep their allocation and only the others are solved
         :return:
         """
-        # Get data
-        positions = self.dao.get_positions(as_of_date)
-        sec_coefficients = self.dao.get_security_pb_coefficients(as_of_date)
-        normalized_coefficients = self.normalize_coefficients(sec_coefficients)
-        optimization_priorities = self.dao.get_optimization_priorities()
-        optimization_priorities = optimization_priorities['weight'].values
-        security_index = self.get_security_universe(positions, normalized_coefficients, trade_list)
-        # Call function to format inputs for optimization
-        values, coefficients, trade = self.format_optimization_inputs(security_index, positions,
-                                                                      normalized_coefficients, trade_list)
-        allocations_shape = values.shape
-        allocations_flat = np.zeros(shape=allocations_shape).reshape(-1)
-
-        # Individual allocations must be between 0 and 1
-        bounds = [(0, 1) for _ in range(allocations_flat.shape[0])]
-
-        # Create constraints
-        # TODO: This should be enhanced and defined somewhere else
-        def constraint_sum_col(allocations_flat, col, shape, target):
-            return sum(allocations_flat[i * shape[1] + col] for i in range(shape[0])) - target
-        constraints = []
-        for i in range(allocations_shape[1]):
-            target = 1 if trade[i] > 0 else 0
-            constraints.append({'type': 'eq', 'fun': constraint_sum_col, 'args': (i, allocations_shape, target)})
-
-        result = minimize(self.calculate_metrics, allocations_flat, args=(values, coefficients, optimization_priorities, trade),
-                          constraints=constraints, bounds=bounds)
-
-        # Format results
-        allocations = result.x.reshape(allocations_shape[0], allocations_shape[1])
-        pb_codes = sec_coefficients['counterparty'].unique()
-        allocated_trade = self.format_results(allocations, trade, pb_codes, security_index)
+        if self.batch_window > 0 and not decompose and prior_allocation is None:
+            return await self.allocate_in_batch(as_of_date, trade_list, solver, timer, allocation_id)
+        return await self.run_in_executor(self.allocate_trade_list_sync, as_of_date, trade_list, solver, decompose,
+                                          timer, allocation_id, prior_allocation)
+
+    async def allocate_in_batch(self, as_of_date: datetime, trade_list: pd.DataFrame, solver: str = 'lp',
+                                timer: Optional[StageTimer] = None, allocation_id: Optional[str] = None
+                                ) -> pd.DataFrame:
+        """
+        Queue trade_list with the other trade lists of the same date and solver received within batch_window, and
+        return its allocation once the batch is solved as one problem
+        """
+        loop = asyncio.get_running_loop()
+        key = (as_of_date.strftime('%Y-%m-%d'), solver)
+        batch = self._pending_batches.get(key)
+        if batch is None:
+            batch = self._pending_batches[key] = []
+            loop.call_later(self.batch_window, self._close_batch, key, as_of_date, solver)
+        future = loop.create_future()
+        batch.append((trade_list, timer, allocation_id, future))
+        return await future
+
+    def _close_batch(self, key: tuple, as_of_date: datetime, solver: str) -> None:
+        batch = self._pending_batches.pop(key)
+        task = asyncio.ensure_future(self._solve_batch(as_of_date, solver, batch))
+        self._batch_tasks.add(task)
+        task.add_done_callback(self._batch_tasks.discard)
+
+    async def _solve_batch(self, as_of_date: datetime, solver: str, batch: list) -> None:
+        trade_lists, timers, allocation_ids, futures = zip(*batch)
+        request_timers = [timer for timer in timers if timer is not None]
+        timer = StageTimer(profile=any(timer.profile for timer in request_timers)) if request_timers else None
+        try:
+            results = await self.run_in_executor(self.allocate_combined_sync, as_of_date, list(trade_lists), solver,
+                                                 timer, list(allocation_ids))
+        except Exception as e:
+            results = [e] * len(batch)
+        for request_timer, future, result in zip(timers, futures, results):
+            if request_timer is not None:
+                request_timer.add(timer)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def run_in_executor(self, func, *args):
+        """
+        Run func in the optimizer executor
+        :raises OptimizerBusyError: if all workers are busy and the queue is full
+        """
+        if not self._capacity.acquire(blocking=False):
+            raise OptimizerBusyError("Too many allocations in progress, retry later")
+        try:
+            future = self.executor.submit(func, *args)
+        except BaseException:
+            self._capacity.release()
+            raise
+        future.add_done_callback(lambda _: self._capacity.release())
+        return await asyncio.wrap_future(future)
+
+    async def allocate_trade_lists(self, as_of_date: datetime, trade_lists: list, solver: str = 'lp',
+                                   timer: Optional[StageTimer] = None) -> list:
+        """
+        Allocate several independent trade lists for the same date. The date's data and priorities are loaded once
+        and a failing trade list does not fail the others
+        :param as_of_date:
+        :param trade_lists: list of trade list dataframes
+        :param solver: 'lp' (HiGHS), 'exact' (closed form) or 'slsqp'
+        :param timer: [Optional] collects stage timings, problem dimensions and solver statistics
+        :return: list of AllocationResult, in the order of trade_lists
+        """
+        return await self.run_in_executor(self.allocate_trade_lists_sync, as_of_date, trade_lists, solver, timer)
+
+    async def evaluate_scenarios(self, as_of_date: datetime, trade_list: pd.DataFrame, scenarios: list,
+                                 solver: str = 'lp', timer: Optional[StageTimer] = None) -> list:
+        """
+        Allocate trade_list under several sets of optimization priorities, without changing the stored priorities
+        :param as_of_date:
+        :param trade_list:
+        :param scenarios: list of priority dataframes with metric_name and weight columns
+        :param solver: 'lp' (HiGHS), 'exact' (closed form) or 'slsqp'
+        :param timer: [Optional] collects stage timings, problem dimensions and solver statistics
+        :return: list of ScenarioResult, in the order of scenarios
+        """
+        return await self.run_in_executor(self.evaluate_scenarios_sync, as_of_date, trade_list, scenarios, solver,
+                                          timer)
+
+    def allocate_trade_list_sync(self, as_of_date: datetime, trade_list: pd.DataFrame, solver: str = 'lp',
+                                 decompose: bool = False, timer: Optional[StageTimer] = None,
+                                 allocation_id: Optional[str] = None,
+                                 prior_allocation: Union[str, pd.DataFrame, PriorAllocation, None] = None
+                                 ) -> pd.DataFrame:
+        """
+        Blocking version of allocate_trade_list
+        """
+        timer = timer or NULL_TIMER
+        with timer.profiling():
+            # Securities that are not traded only add a constant to the objective, so the optimization is restricted
+            # to the trade list and only those securities are loaded
+            security_index = pd.Index(trade_list['security_id'].unique())
+            prior = self.get_prior_allocation(prior_allocation)
+            # Get data
+            snapshot = self.get_snapshot(as_of_date, security_index, timer)
+            with timer.stage('get_optimization_priorities'):
+                optimization_priorities = self.dao.get_optimization_priorities()
+                optimization_priorities = self.align_priorities(optimization_priorities, snapshot.metric_names)
+            with timer.stage('get_allocation_constraints'):
+                allocation_constraints = self.dao.get_allocation_constraints()
+                pb_positions = self.get_pb_positions(as_of_date, allocation_constraints, snapshot.pb_codes)
+            with timer.stage('select_inputs'):
+                trade = self.format_trade(security_index, trade_list)
+                constraints = compile_constraints(allocation_constraints, snapshot.pb_codes, security_index, trade,
+                                                  pb_positions)
+                # Without constraints across securities, securities traded for the same amount as in a prior
+                # allocation solved with the same data, priorities and constraints keep their allocation
+                if prior is not None and not constraints.couples_securities and prior.is_compatible(
+                        as_of_date, snapshot.data_version, optimization_priorities, snapshot.pb_codes):
+                    unchanged = prior.unchanged(security_index, trade)
+                else:
+                    unchanged = np.zeros(len(security_index), dtype=bool)
+                solve_index = security_index[~unchanged]
+                if unchanged.any():
+                    constraints = compile_constraints(allocation_constraints, snapshot.pb_codes, solve_index,
+                                                      trade[~unchanged], pb_positions)
+                values, coefficients = snapshot.select(solve_index)
+                # The prior also seeds the solver's starting point for the securities that changed
+                initial_allocations = prior.select(solve_index, snapshot.pb_codes) if prior is not None else None
+            timer.set_dimensions(pbs=coefficients.shape[0], metrics=coefficients.shape[1],
+                                 securities=coefficients.shape[2], carried_over=int(unchanged.sum()),
+                                 constraint_rows=constraints.n_rows)
+
+            with timer.stage('solve'):
+                if decompose and len(solve_index) and not constraints.couples_securities:
+                    solved, results = solve_decomposed(self.process_pool, solver, self.calculate_metrics, values,
+                                                       coefficients, optimization_priorities, trade[~unchanged],
+                                                       self.max_processes, self.calculate_metrics_gradient,
+                                                       constraints.upper_bounds)
+                else:
+                    # Constraints across securities need the whole problem, the blocks of a decomposition are
+                    # independent
+                    solved, result = solve_trade_allocation(solver, values, coefficients, optimization_priorities,
+                                                            trade[~unchanged], initial_allocations, constraints)
+                    results = [result]
+                allocations = np.zeros((len(snapshot.pb_codes), len(security_index)))
+                allocations[:, ~unchanged] = solved
+                if unchanged.any():
+                    allocations[:, unchanged] = prior.select(security_index[unchanged], snapshot.pb_codes)
+            for result in results:
+                timer.record_solver(result)
+
+            self.store_allocation(allocation_id, snapshot, security_index, allocations, trade,
+                                  optimization_priorities)
+
+            # Format results
+            with timer.stage('format_results'):
+                allocated_trade = self.format_results(allocations, trade, snapshot.pb_codes, security_index)
         return allocated_trade
 
-    def get_security_universe(self, positions: pd.DataFrame, coefficients: pd.DataFrame, trade: pd.DataFrame) -> pd.Index:
+    def evaluate_scenarios_sync(self, as_of_date: datetime, trade_list: pd.DataFrame, scenarios: list,
+                                solver: str = 'lp', timer: Optional[StageTimer] = None) -> list:
+        """
+        Blocking version of evaluate_scenarios. The data and matrices are built once for every scenario
+        """
+        timer = timer or NULL_TIMER
+        with timer.profiling():
+            security_index = pd.Index(trade_list['security_id'].unique())
+            snapshot = self.get_snapshot(as_of_date, security_index, timer)
+            with timer.stage('align_priorities'):
+                for priorities in scenarios:
+                    unknown = set(priorities['metric_name']).difference(snapshot.metric_names)
+                    if unknown:
+                        raise ValueError(f"Unknown metrics {sorted(unknown)}")
+                priorities_matrix = np.array([self.align_priorities(priorities, snapshot.metric_names)
+                                              for priorities in scenarios]).reshape(len(scenarios),
+                                                                                    len(snapshot.metric_names))
+            with timer.stage('get_allocation_constraints'):
+                allocation_constraints = self.dao.get_allocation_constraints()
+                pb_positions = self.get_pb_positions(as_of_date, allocation_constraints, snapshot.pb_codes)
+            with timer.stage('select_inputs'):
+                values, coefficients = snapshot.select(security_index)
+                trade = self.format_trade(security_index, trade_list)
+                constraints = compile_constraints(allocation_constraints, snapshot.pb_codes, security_index, trade,
+                                                  pb_positions)
+            timer.set_dimensions(pbs=coefficients.shape[0], metrics=coefficients.shape[1],
+                                 securities=coefficients.shape[2], scenarios=len(scenarios),
+                                 constraint_rows=constraints.n_rows)
+
+            with timer.stage('solve'):
+                allocations, results = solve_scenarios(solver, self.calculate_metrics, values, coefficients,
+                                                       priorities_matrix, trade, self.calculate_metrics_gradient,
+                                                       constraints)
+            for result in results:
+                timer.record_solver(result)
+            with timer.stage('calculate_metric_breakdown'):
+                metric_values = self.calculate_metric_breakdown(allocations, values, coefficients, trade)
+                contributions = metric_values * priorities_matrix
+
+            with timer.stage('format_results'):
+                scenario_results = []
+                for i in range(len(scenarios)):
+                    scenario_results.append(ScenarioResult(
+                        allocations=self.format_results(allocations[i], trade, snapshot.pb_codes, security_index),
+                        objective=float(contributions[i].sum()),
+                        metric_values=dict(zip(snapshot.metric_names, metric_values[i].tolist())),
+                        metric_contributions=dict(zip(snapshot.metric_names, contributions[i].tolist()))))
+        return scenario_results
+
+    def prepare_trade_lists(self, as_of_date: datetime, trade_lists: list, timer: StageTimer) -> tuple:
+        """
+        Load the data of several trade lists of the same date at once and build the inputs of each of them. A trade
+        list whose inputs cannot be built does not fail the others
+        :param as_of_date:
+        :param trade_lists: list of trade list dataframes
+        :param timer: collects the timings of the loading stages
+        :return: the snapshot (None if no trade list is valid), the aligned optimization priorities, and dicts by
+            position in trade_lists of the security indexes, (positions, coefficients, trade) inputs and compiled
+            constraints of the valid trade lists and of the exception raised for the others
+        """
+        security_indexes, inputs, constraints, errors = {}, {}, {}, {}
+        trade_lists = list(trade_lists)
+        for i, trade_list in enumerate(trade_lists):
+            try:
+                # Invalid security ids fail their own trade list here instead of the data load shared by all of them
+                trade_lists[i] = trade_list.assign(security_id=trade_list['security_id'].astype(np.int64))
+                security_indexes[i] = pd.Index(trade_lists[i]['security_id'].unique())
+            except Exception as e:
+                errors[i] = e
+        if not security_indexes:
+            return None, None, security_indexes, inputs, constraints, errors
+
+        # Get data for every trade list at once
+        security_universe = pd.Index(np.concatenate([index.to_numpy()
+                                                     for index in security_indexes.values()])).unique()
+        snapshot = self.get_snapshot(as_of_date, security_universe, timer)
+        with timer.stage('get_optimization_priorities'):
+            optimization_priorities = self.dao.get_optimization_priorities()
+            optimization_priorities = self.align_priorities(optimization_priorities, snapshot.metric_names)
+        with timer.stage('get_allocation_constraints'):
+            allocation_constraints = self.dao.get_allocation_constraints()
+            pb_positions = self.get_pb_positions(as_of_date, allocation_constraints, snapshot.pb_codes)
+
+        with timer.stage('select_inputs'):
+            for i, security_index in security_indexes.items():
+                try:
+                    values, coefficients = snapshot.select(security_index)
+                    trade = self.format_trade(security_index, trade_lists[i])
+                    constraints[i] = compile_constraints(allocation_constraints, snapshot.pb_codes, security_index,
+                                                         trade, pb_positions)
+                    inputs[i] = (values, coefficients, trade)
+                except Exception as e:
+                    errors[i] = e
+        return snapshot, optimization_priorities, security_indexes, inputs, constraints, errors
+
+    def allocate_combined_sync(self, as_of_date: datetime, trade_lists: list, solver: str = 'lp',
+                               timer: Optional[StageTimer] = None, allocation_ids: Optional[list] = None) -> list:
+        """
+        Allocate several trade lists of the same date as one problem. The sum constraints and security limits are per
+        security, so each trade list keeps its own copy of the securities it trades and the combined solution splits
+        back exactly. PB capacities and shares apply to each trade list, so when there are some every trade list is
+        solved on its own, as they are when the combined problem fails
+        :param as_of_date:
+        :param trade_lists: list of trade list dataframes
+        :param solver: 'lp' (HiGHS), 'exact' (closed form) or 'slsqp'
+        :param timer: [Optional] collects stage timings, problem dimensions and solver statistics of the batch
+        :param allocation_ids: [Optional] id to keep each allocation under in the allocation store, or None
+        :return: allocations dataframe of each trade list, or the exception raised for it
+        """
+        timer = timer or NULL_TIMER
+        allocation_ids = allocation_ids or [None] * len(trade_lists)
+        results = [None] * len(trade_lists)
+        with timer.profiling():
+            snapshot, optimization_priorities, security_indexes, inputs, constraints, errors = \
+                self.prepare_trade_lists(as_of_date, trade_lists, timer)
+            for i, error in errors.items():
+                results[i] = error
+            if not inputs:
+                return results
+            with timer.stage('select_inputs'):
+                values = np.concatenate([values for values, _, _ in inputs.values()], axis=1)
+                coefficients = np.concatenate([coefficients for _, coefficients, _ in inputs.values()], axis=2)
+                trade = np.concatenate([trade for _, _, trade in inputs.values()])
+            timer.set_dimensions(pbs=coefficients.shape[0], metrics=coefficients.shape[1],
+                                 securities=coefficients.shape[2], trade_lists=len(inputs))
+
+            if any(constraints[i].couples_securities for i in inputs):
+                return self._allocate_separately(snapshot, inputs, constraints, security_indexes, solver,
+                                                 optimization_priorities, timer, allocation_ids, results)
+            try:
+                with timer.stage('solve'):
+                    combined_constraints = LinearConstraints(
+                        A_ub=None, b_ub=None,
+                        upper_bounds=np.concatenate([constraints[i].upper_bounds for i in inputs], axis=1))
+                    allocations, result = solve_trade_allocation(solver, values, coefficients,
+                                                                 optimization_priorities, trade,
+                                                                 constraints=combined_constraints)
+            except Exception:
+                # e.g. the security limits of one trade list leave a security unallocatable, so the trade lists
+                # are solved one by one to fail only that one
+                return self._allocate_separately(snapshot, inputs, constraints, security_indexes, solver,
+                                                 optimization_priorities, timer, allocation_ids, results)
+            timer.record_solver(result)
+
+            with timer.stage('format_results'):
+                start = 0
+                for i, (_, _, trade) in inputs.items():
+                    stop = start + len(trade)
+                    self.store_allocation(allocation_ids[i], snapshot, security_indexes[i], allocations[:, start:stop],
+                                          trade, optimization_priorities)
+                    results[i] = self.format_results(allocations[:, start:stop], trade, snapshot.pb_codes,
+                                                     security_indexes[i])
+                    start = stop
+        return results
+
+    def _allocate_separately(self, snapshot: OptimizationSnapshot, inputs: dict, constraints: dict,
+                             security_indexes: dict, solver: str, optimization_priorities: np.ndarray,
+                             timer: StageTimer, allocation_ids: list, results: list) -> list:
+        """
+        Solve the trade lists of allocate_combined_sync one by one, with their own constraints
+        """
+        for i, (values, coefficients, trade) in inputs.items():
+            try:
+                with timer.stage('solve'):
+                    allocations, result = solve_trade_allocation(solver, values, coefficients,
+                                                                 optimization_priorities, trade,
+                                                                 constraints=constraints[i])
+                timer.record_solver(result)
+                with timer.stage('format_results'):
+                    self.store_allocation(allocation_ids[i], snapshot, security_indexes[i], allocations, trade,
+                                          optimization_priorities)
+                    results[i] = self.format_results(allocations, trade, snapshot.pb_codes, security_indexes[i])
+            except Exception as e:
+                results[i] = e
+        return results
+
+    def store_allocation(self, allocation_id: Optional[str], snapshot: OptimizationSnapshot,
+                         security_index: pd.Index, allocations: np.ndarray, trade: np.ndarray,
+                         optimization_priorities: np.ndarray) -> None:
+        """
+        Keep an allocation in the allocation store for incremental re-allocation, if allocation_id is provided
+        """
+        if allocation_id is None:
+            return
+        self.allocation_store.put(allocation_id, PriorAllocation(
+            fractions=pd.DataFrame(allocations.T, index=security_index, columns=snapshot.pb_codes),
+            trade=pd.Series(trade, index=security_index), as_of_date=snapshot.as_of_date,
+            data_version=snapshot.data_version, optimization_priorities=optimization_priorities))
+
+    def get_prior_allocation(self, prior_allocation: Union[str, pd.DataFrame, PriorAllocation, None]
+                             ) -> Optional[PriorAllocation]:
+        """
+        Return prior_allocation as a PriorAllocation
+        :param prior_allocation: id in the allocation store, allocations returned by allocate_trade_list or
+            PriorAllocation
+        :return: the prior, or None if the id is not in the allocation store
+        """
+        if prior_allocation is None or isinstance(prior_allocation, PriorAllocation):
+            return prior_allocation
+        if isinstance(prior_allocation, pd.DataFrame):
+            return PriorAllocation.from_allocations(prior_allocation)
+        prior = self.allocation_store.get(prior_allocation)
+        if prior is None:
+            # The store is per process, the id may have been allocated by another worker or evicted
+            logger.info("Prior allocation '%s' is not in the allocation store, solving in full", prior_allocation)
+        return prior
+
+    def allocate_trade_lists_sync(self, as_of_date: datetime, trade_lists: list, solver: str = 'lp',
+                                  timer: Optional[StageTimer] = None) -> list:
+        """
+        Blocking version of allocate_trade_lists. Large batches are solved in the process pool
+        """
+        timer = timer or NULL_TIMER
+        results = [None] * len(trade_lists)
+        with timer.profiling():
+            snapshot, optimization_priorities, security_indexes, inputs, constraints, errors = \
+                self.prepare_trade_lists(as_of_date, trade_lists, timer)
+            for i, error in errors.items():
+                results[i] = AllocationResult(error=f"Invalid trade list: {error}")
+            if not inputs:
+                return results
+            timer.set_dimensions(pbs=len(snapshot.pb_codes), metrics=len(snapshot.metric_names),
+                                 securities=sum(len(security_indexes[i]) for i in inputs),
+                                 trade_lists=len(trade_lists))
+
+            problem_size = sum(values.size for values, _, _ in inputs.values())
+            use_process_pool = len(inputs) > 1 and problem_size >= self.process_pool_threshold
+            futures = {}
+            if use_process_pool:
+                futures = {i: self.process_pool.submit(solve_trade_allocation, solver, values, coefficients,
+                                                       optimization_priorities, trade, None, constraints[i])
+                           for i, (values, coefficients, trade) in inputs.items()}
+
+            for i, (values, coefficients, trade) in inputs.items():
+                try:
+                    with timer.stage('solve'):
+                        if use_process_pool:
+                            allocations, result = futures[i].result()
+                        else:
+                            allocations, result = solve_trade_allocation(solver, values, coefficients,
+                                                                         optimization_priorities, trade,
+                                                                         constraints=constraints[i])
+                    timer.record_solver(result)
+                    with timer.stage('format_results'):
+                        allocated_trade = self.format_results(allocations, trade, snapshot.pb_codes,
+                                                              security_indexes[i])
+                    results[i] = AllocationResult(allocations=allocated_trade)
+                except Exception as e:
+                    results[i] = AllocationResult(error=str(e))
+        return results
+
+    def get_snapshot(self, as_of_date: datetime, security_index: Optional[pd.Index] = None,
+                     timer: Optional[StageTimer] = None) -> OptimizationSnapshot:
+        """
+        Return the optimization inputs for as_of_date covering security_index, from the snapshot cache or the snapshot
+        files if available. Securities missing from the cached snapshot are loaded and merged into it. Only one load
+        runs at a time for a date: concurrent callers wait for it, and the securities that load did not cover are
+        loaded together by the next one
+        :param as_of_date:
+        :param security_index: [Optional] securities needed, every security of the date if not provided
+        :param timer: [Optional] collects the timings of the loading stages
+        :return:
+        """
+        timer = timer or NULL_TIMER
+        key = as_of_date.strftime('%Y-%m-%d')
+        while True:
+            snapshot = self.snapshot_cache.get(as_of_date, self.dao.data_version)
+            if snapshot is not None and snapshot.covers(security_index):
+                return snapshot
+            with self._loads_lock:
+                load = self._loads.get(key)
+                if load is None:
+                    load = self._loads[key] = threading.Event()
+                    requested = self._waiting.pop(key, [])
+                    break
+                # The next load of the date includes these securities
+                self._waiting.setdefault(key, []).append(security_index)
+            with timer.stage('wait_for_load'):
+                load.wait()
+            # Withdraw the securities, they are requested again if the load that finished did not cover them
+            with self._loads_lock:
+                self._discard_waiting(key, security_index)
+
+        # Load the securities of every caller that waited on the previous load at once
+        if security_index is not None and requested:
+            if any(index is None for index in requested):
+                security_index = None
+            else:
+                security_index = security_index.append(requested).unique()
+        try:
+            # The load that was waited for may have covered this request as well
+            snapshot = self.snapshot_cache.get(as_of_date, self.dao.data_version)
+            if snapshot is None and self.snapshot_directory is not None:
+                snapshot = self.load_snapshot_file(as_of_date, timer)
+            if snapshot is not None and snapshot.covers(security_index):
+                self.snapshot_cache.put(snapshot)
+                return snapshot
+            if snapshot is None or security_index is None:
+                snapshot = self.build_snapshot(as_of_date, security_index, timer)
+            else:
+                missing = security_index.difference(snapshot.security_index, sort=False)
+                snapshot = snapshot.merge(self.build_snapshot(as_of_date, missing, timer))
+            self.snapshot_cache.put(snapshot)
+            return snapshot
+        finally:
+            with self._loads_lock:
+                del self._loads[key]
+            load.set()
+
+    def _discard_waiting(self, key: str, security_index: Optional[pd.Index]) -> None:
+        """
+        Remove the securities requested by a caller of get_snapshot from the next load of the date, if that load has
+        not started yet. Called with _loads_lock held
+        """
+        waiting = self._waiting.get(key, [])
+        for i, index in enumerate(waiting):
+            if index is security_index:
+                del waiting[i]
+                break
+        if not waiting:
+            self._waiting.pop(key, None)
+
+    def load_snapshot_file(self, as_of_date: datetime, timer: Optional[StageTimer] = None
+                           ) -> Optional[OptimizationSnapshot]:
+        """
+        Memory map the snapshot files of as_of_date from snapshot_directory
+        :param as_of_date:
+        :param timer: [Optional] collects the timing of the load
+        :return: the snapshot, or None if there are no usable files for the date
+        """
+        timer = timer or NULL_TIMER
+        data_version = self.dao.data_version
+        with timer.stage('load_snapshot_file'):
+            snapshot = load_snapshot(self.snapshot_directory, as_of_date, data_version,
+                                     data_loads=self.dao.get_data_loads(SNAPSHOT_TABLES))
+        if snapshot is None:
+            return None
+        if not np.isclose(snapshot.missing_coefficient_value, self.missing_coefficient_value, equal_nan=True):
+            logger.warning("Snapshot file for %s uses a missing coefficient value of %s, loading from the database",
+                           snapshot.as_of_date, snapshot.missing_coefficient_value)
+            return None
+        return snapshot
+
+    def build_snapshot(self, as_of_date: datetime, security_index: Optional[pd.Index] = None,
+                       timer: Optional[StageTimer] = None) -> OptimizationSnapshot:
+        """
+        Load positions and coefficients for as_of_date and build the optimization matrices. When security_index is
+        provided only those securities are loaded, the normalization uses the precomputed coefficient statistics so it
+        does not depend on which securities are loaded
+        :param as_of_date:
+        :param security_index: [Optional] securities to load, every security of the date if not provided
+        :param timer: [Optional] collects the timings of the loading stages
+        :return:
+        """
+        timer = timer or NULL_TIMER
+        data_version = self.dao.data_version
+        security_ids = security_index.tolist() if security_index is not None else None
+        with timer.stage('get_positions'):
+            positions = self.dao.get_positions(as_of_date, security_id=security_ids,
+                                               columns=['counterparty', 'security_id', 'market_value'])
+        with timer.stage('get_security_pb_coefficients'):
+            sec_coefficients = self.dao.get_security_pb_coefficients(
+                as_of_date, security_id=security_ids,
+                columns=['counterparty', 'security_id', 'metric_name', 'coefficient_value'])
+        with timer.stage('get_coefficient_statistics'):
+            statistics = self.dao.get_coefficient_statistics(as_of_date)
+        with timer.stage('normalize_coefficients'):
+            normalized_coefficients = self.normalize_coefficients(sec_coefficients, statistics)
+        with timer.stage('format_optimization_inputs'):
+            if security_index is None:
+                security_index = self.get_security_universe(positions, normalized_coefficients)
+            values, coefficients, pb_codes, metric_names = self.format_optimization_inputs(
+                security_index, positions, normalized_coefficients, statistics['counterparty'].unique(),
+                np.sort(statistics['metric_name'].unique()))
+        return OptimizationSnapshot(as_of_date=as_of_date.strftime('%Y-%m-%d'), data_version=data_version,
+                                    pb_codes=pb_codes, metric_names=metric_names, security_index=security_index,
+                                    positions_matrix=values, coefficients_matrix=coefficients,
+                                    missing_coefficient_value=self.missing_coefficient_value,
+                                    complete=security_ids is None)
+
+    def invalidate_snapshots(self, as_of_date: Optional[datetime] = None) -> None:
+        """
+        Drop cached optimization inputs for as_of_date, or for every date if not provided
+        :param as_of_date:
+        """
+        self.snapshot_cache.invalidate(as_of_date)
+
+    def get_security_universe(self, positions: pd.DataFrame, coefficients: pd.DataFrame,
+                              trade: Optional[pd.DataFrame] = None) -> pd.Index:
         """
         Return the uinverse of securities to be used in the optimization
         :param positions:
         :param coefficients:
-        :param trade:
+        :param trade: [Optional] trade list
         :return:
         """
-        security_universe = pd.concat([trade['security_id'], positions['security_id'],
-                                       coefficients['security_id']]).unique()
+        security_ids = [positions['security_id'], coefficients['security_id']]
+        if trade is not None:
+            security_ids.insert(0, trade['security_id'])
+        security_universe = pd.concat(security_ids).unique()
         security_index = pd.Index(security_universe)
         return security_index
 
-    def format_optimization_inputs(self, security_index: pd.Index, positions: pd.DataFrame, coefficients: pd.DataFrame,
-                                   trade: pd.DataFrame) -> tuple:
+    def format_optimization_inputs(self, security_index: pd.Index, positions: pd.DataFrame,
+                                   coefficients: pd.DataFrame, pb_codes: Optional[np.ndarray] = None,
+                                   metric_names: Optional[np.ndarray] = None) -> tuple:
         """
-        Create matrices to be used in the optimization
+        Create matrices to be used in the optimization. Counterparties, metrics and securities are encoded as integer
+        codes once and the values scattered into preallocated arrays
         :param security_index:
         :param positions:
         :param coefficients:
-        :param optimization_priorities:
+        :param pb_codes: [Optional] PB axis, taken from the coefficients if not provided
+        :param metric_names: [Optional] metric axis, taken from the coefficients (sorted) if not provided
+        :return: (pb, security) positions matrix, (pb, metric, security) coefficients matrix, PB codes and metric
+            names in the order of the matrix axes
+        """
+        if pb_codes is None:
+            pb_codes = pd.factorize(coefficients['counterparty'])[1]
+        if metric_names is None:
+            metric_names = pd.factorize(coefficients['metric_name'], sort=True)[1]
+        pb_idx = pd.Index(pb_codes).get_indexer(coefficients['counterparty'])
+        metric_idx = pd.Index(metric_names).get_indexer(coefficients['metric_name'])
+        security_idx = security_index.get_indexer(coefficients['security_id'])
+        valid = (pb_idx >= 0) & (metric_idx >= 0) & (security_idx >= 0)
+        coefficients_matrix = np.full((len(pb_codes), len(metric_names), len(security_index)),
+                                      self.missing_coefficient_value, dtype=float)
+        coefficients_matrix[pb_idx[valid], metric_idx[valid], security_idx[valid]] = \
+            coefficients['coefficient_value'].to_numpy(dtype=float)[valid]
+
+        # Positions for the same PB and security in several portfolios are added up, positions with PBs that have no
+        # coefficients are not part of the optimization
+        position_pb_idx = pd.Index(pb_codes).get_indexer(positions['counterparty'])
+        position_security_idx = security_index.get_indexer(positions['security_id'])
+        valid = (position_pb_idx >= 0) & (position_security_idx >= 0)
+        values_matrix = np.zeros((len(pb_codes), len(security_index)))
+        np.add.at(values_matrix, (position_pb_idx[valid], position_security_idx[valid]),
+                  positions['market_value'].to_numpy(dtype=float)[valid])
+        return values_matrix, coefficients_matrix, np.asarray(pb_codes), np.asarray(metric_names)
+
+    def align_priorities(self, optimization_priorities: pd.DataFrame, metric_names: np.ndarray) -> np.ndarray:
+        """
+        Return the priority weights in the order of the metric axis of the coefficients matrix. Metrics without a
+        priority get a weight of zero
+        :param optimization_priorities: dataframe with metric_name and weight columns
+        :param metric_names:
+        :return:
+        """
+        weights = optimization_priorities.set_index('metric_name')['weight']
+        return weights.reindex(metric_names).fillna(0).to_numpy(dtype=float)
+
+    def get_pb_positions(self, as_of_date: datetime, allocation_constraints: pd.DataFrame,
+                         pb_codes: np.ndarray) -> Optional[np.ndarray]:
+        """
+        Return the market value of the date's positions held with each PB, needed by pb_capacity constraints
+        :param as_of_date:
+        :param allocation_constraints:
+        :param pb_codes:
+        :return: (pb,) array aligned to pb_codes, or None if there are no pb_capacity constraints
+        """
+        if not (allocation_constraints['constraint_type'] == 'pb_capacity').any():
+            return None
+        totals = self.dao.get_pb_position_totals(as_of_date).set_index('counterparty')['market_value']
+        return totals.reindex(pb_codes).fillna(0).to_numpy(dtype=float)
+
+    def format_trade(self, security_index: pd.Index, trade: pd.DataFrame) -> np.ndarray:
+        """
+        Return the traded market value aligned to security_index
+        :param security_index:
         :param trade:
         :return:
         """
-        # Reindex trade list
         trade = trade.loc[:, ['security_id', 'market_value']]
         trade = trade.set_index('security_id').reindex(security_index).fillna(0)
-        trade = trade['market_value'].values
-        # Iterate through PB accounts to build required matrices
-        pb_codes = coefficients['counterparty'].unique()
-        coefs = []
-        vals = []
-        for pb in pb_codes:
-            pb_positions = positions.loc[positions['counterparty'] == pb, ['security_id', 'market_value']]
-            pb_positions.set_index('security_id', inplace=True)
-            pb_positions = pb_positions.reindex(security_index).fillna(0)
-            coefficients_pb = coefficients.loc[coefficients['counterparty'] == pb, ['security_id', 'metric_name', 'coefficient_value']]
-            coefficients_pb = coefficients_pb.set_index(['metric_name', 'security_id']).unstack('security_id')
-            coefficients_pb = coefficients_pb['coefficient_value']
-            coefficients_pb = coefficients_pb.reindex(columns=security_index)
-            coefs.append(coefficients_pb)
-            vals.append(pb_positions['market_value'])
-        coefficients_matrix = np.stack(coefs)
-        values_matrix = np.stack(vals)
-        return values_matrix, coefficients_matrix, trade
-
-    def calculate_metrics(self, allocation_vector: np.ndarray, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
+        return trade['market_value'].values
+
+    @staticmethod
+    def calculate_metrics(allocation_vector: np.ndarray, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
                           optimization_priorities: np.ndarray, trade: np.ndarray) -> float:
         allocation_matrix = allocation_vector.reshape(positions_matrix.shape[0], positions_matrix.shape[1])
         values_matrix = positions_matrix + allocation_matrix * trade
         metrics = np.einsum('m,pms,ps->',optimization_priorities, coefficients_matrix, values_matrix)
         return metrics
 
-    def normalize_coefficients(self, pb_coefficients: pd.DataFrame) -> pd.DataFrame:
+    @staticmethod
+    def calculate_metrics_gradient(allocation_vector: np.ndarray, positions_matrix: np.ndarray,
+                                   coefficients_matrix: np.ndarray, optimization_priorities: np.ndarray,
+                                   trade: np.ndarray) -> np.ndarray:
+        """
+        Analytic gradient of calculate_metrics. The metrics are linear in the allocations so the gradient does not
+        depend on allocation_vector
+        :return: flattened (pb, security) gradient
+        """
+        gradient = np.einsum('m,pms,s->ps', optimization_priorities, coefficients_matrix, trade)
+        return gradient.reshape(-1)
+
+    @staticmethod
+    def calculate_metric_breakdown(allocations: np.ndarray, positions_matrix: np.ndarray,
+                                   coefficients_matrix: np.ndarray, trade: np.ndarray) -> np.ndarray:
+        """
+        Unweighted metric totals of several allocations at once, calculate_metrics is the priority weighted sum of
+        these
+        :param allocations: (scenario, pb, security) array
+        :return: (scenario, metric) array
+        """
+        values = positions_matrix + allocations * trade
+        return np.einsum('pms,nps->nm', coefficients_matrix, values)
+
+    def normalize_coefficients(self, pb_coefficients: pd.DataFrame, statistics: Optional[pd.DataFrame] = None) -> pd.DataFrame:
         """
         Normalize pb coefficients so optimization is not dominated by coefficients with large magnitude
         :param pb_coefficients:
+        :param statistics: [Optional] min_val and max_val by counterparty and metric_name, computed from
+            pb_coefficients if not provided
         :return:
         """
         group_cols = ['counterparty', 'metric_name']
-        pb_coefficients['min_val'] = pb_coefficients.groupby(group_cols)['coefficient_value'].transform('min')
-        pb_coefficients['max_val'] = pb_coefficients.groupby(group_cols)['coefficient_value'].transform('max')
+        if statistics is None:
+            pb_coefficients['min_val'] = pb_coefficients.groupby(group_cols)['coefficient_value'].transform('min')
+            pb_coefficients['max_val'] = pb_coefficients.groupby(group_cols)['coefficient_value'].transform('max')
+        else:
+            pb_coefficients = pb_coefficients.merge(statistics[group_cols + ['min_val', 'max_val']], on=group_cols,
+                                                    how='left')
         # Avoid divide by zero (if min = max)
         pb_coefficients['coefficient_value'] = ((pb_coefficients['coefficient_value'] - pb_coefficients['min_val']) /
                                          (pb_coefficients['max_val'] - pb_coefficients['min_val']).replace(0, 1))
@@ -123,16 +799,30 @@ class PBOptimizer:
         return pb_coefficients
 
     def format_results(self, allocations: np.ndarray, trade: np.ndarray, pb_codes, security_universe) -> dict:
-        allocations = np.round(allocations, decimals=2).transpose()
-        allocations_df = pd.DataFrame(data=allocations, index=security_universe, columns=pb_codes)
-        trade_allocations = allocations_df.mul(trade, axis=0)
+        # Round the market values to cents towards zero so an allocation never exceeds its limits or the trade.
+        # The small tolerance keeps solver noise (e.g. 455499.9999999 for a 455500 limit) from losing a cent
+        market_values = allocations.transpose() * trade[:, None]
+        market_values = np.trunc(np.round(market_values * 100, decimals=3)) / 100
+        trade_allocations = pd.DataFrame(data=market_values, index=security_universe, columns=pb_codes)
         trade_allocations = trade_allocations.loc[~(trade_allocations == 0).all(axis=1)]
         return trade_allocations
 
+def solve_trade_allocation(solver: str, values: np.ndarray, coefficients: np.ndarray,
+                           optimization_priorities: np.ndarray, trade: np.ndarray,
+                           initial_allocations: Optional[np.ndarray] = None,
+                           constraints: Optional[LinearConstraints] = None) -> tuple:
+    """
+    Solve one allocation problem and return the (pb, security) allocation matrix and the OptimizeResult. Module level
+    so it can be sent to the process pool
+    """
+    return solve_allocation(solver, PBOptimizer.calculate_metrics, values, coefficients, optimization_priorities,
+                            trade, PBOptimizer.calculate_metrics_gradient, initial_allocations, constraints)
+
+
 if __name__ == "__main__":
     sql_client = sqlite3.connect('portfolio.db')
     initialize_mock_data(sql_client)
-    data_access_layer = DataAccessLayer(sql_client)
+    data_access_layer = DataAccessLayer(ConnectionPool('portfolio.db'))
     optimizer = PBOptimizer(data_access_layer)
     as_of_date = datetime(2024,1,15)
     trade_list = pd.DataFrame({'security_id': [1001, 1002], 'market_value': [50000, 10000]})
@@ -0,0 +1,149 @@
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+
+@dataclass
+class OptimizationSnapshot:
+    """
+    Optimization inputs for one as_of_date that do not depend on the trade list
+    """
+    as_of_date: str
+    data_version: int
+    pb_codes: np.ndarray
+    metric_names: np.ndarray
+    security_index: pd.Index
+    positions_matrix: np.ndarray
+    coefficients_matrix: np.ndarray
+    missing_coefficient_value: float = np.nan
+    # True when every security of the date is loaded, otherwise only the securities in security_index are
+    complete: bool = True
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory held by the snapshot. Memory mapped matrices live in the shared page cache and are not counted
+        """
+        matrices = [matrix.nbytes for matrix in [self.positions_matrix, self.coefficients_matrix]
+                    if not isinstance(matrix, np.memmap)]
+        return sum(matrices) + self.security_index.nbytes + self.pb_codes.nbytes + self.metric_names.nbytes
+
+    def covers(self, security_index: Optional[pd.Index] = None) -> bool:
+        """
+        Return True if the snapshot has the data for security_index (for every security if not provided)
+        :param security_index:
+        :return:
+        """
+        if self.complete:
+            return True
+        return security_index is not None and security_index.isin(self.security_index).all()
+
+    def merge(self, other: 'OptimizationSnapshot') -> 'OptimizationSnapshot':
+        """
+        Return a snapshot with the securities of both snapshots. Both must share the PB and metric axes
+        :param other: snapshot with securities not in this one
+        :return:
+        """
+        return OptimizationSnapshot(as_of_date=self.as_of_date, data_version=min(self.data_version, other.data_version),
+                                    pb_codes=self.pb_codes, metric_names=self.metric_names,
+                                    security_index=self.security_index.append(other.security_index),
+                                    positions_matrix=np.concatenate([self.positions_matrix, other.positions_matrix],
+                                                                    axis=1),
+                                    coefficients_matrix=np.concatenate([self.coefficients_matrix,
+                                                                        other.coefficients_matrix], axis=2),
+                                    missing_coefficient_value=self.missing_coefficient_value,
+                                    complete=self.complete or other.complete)
+
+    def select(self, security_index: pd.Index) -> tuple:
+        """
+        Return the position and coefficient matrices for security_index. Securities not in the snapshot get zero
+        positions and missing_coefficient_value coefficients
+        :param security_index:
+        :return: (pb, security) positions matrix and (pb, metric, security) coefficients matrix
+        """
+        locations = self.security_index.get_indexer(security_index)
+        missing = locations == -1
+        values = self.positions_matrix[:, locations]
+        coefficients = self.coefficients_matrix[:, :, locations]
+        if missing.any():
+            values[:, missing] = 0
+            coefficients[:, :, missing] = self.missing_coefficient_value
+        return values, coefficients
+
+
+class SnapshotCache:
+    """
+    Thread safe LRU cache of OptimizationSnapshot by as_of_date, bounded by number of entries and total size
+    """
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 512 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(as_of_date: datetime) -> str:
+        return as_of_date.strftime('%Y-%m-%d')
+
+    def get(self, as_of_date: datetime, data_version: int) -> Optional[OptimizationSnapshot]:
+        """
+        Return the cached snapshot for as_of_date, or None if there is none for the current data_version
+        :param as_of_date:
+        :param data_version: version of the underlying data, snapshots built from an older version are dropped
+        :return:
+        """
+        key = self._key(as_of_date)
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is not None and snapshot.data_version != data_version:
+                del self._snapshots[key]
+                self.invalidations += 1
+                snapshot = None
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self._snapshots.move_to_end(key)
+            self.hits += 1
+            return snapshot
+
+    def put(self, snapshot: OptimizationSnapshot) -> None:
+        """
+        Add a snapshot to the cache, evicting the least recently used ones if the cache is full
+        :param snapshot:
+        """
+        with self._lock:
+            self._snapshots[snapshot.as_of_date] = snapshot
+            self._snapshots.move_to_end(snapshot.as_of_date)
+            while len(self._snapshots) > 1 and (len(self._snapshots) > self.max_entries or
+                                                self._total_bytes() > self.max_bytes):
+                self._snapshots.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, as_of_date: Optional[datetime] = None) -> None:
+        """
+        Drop the snapshot for as_of_date, or every snapshot if as_of_date is not provided
+        :param as_of_date:
+        """
+        with self._lock:
+            if as_of_date is None:
+                self.invalidations += len(self._snapshots)
+                self._snapshots.clear()
+            elif self._snapshots.pop(self._key(as_of_date), None) is not None:
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._snapshots), 'bytes': self._total_bytes(), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations}
+
+    def _total_bytes(self) -> int:
+        return sum(snapshot.nbytes for snapshot in self._snapshots.values())
@@ -0,0 +1,356 @@
+import logging
+import numpy as np
+from concurrent.futures import Executor
+from multiprocessing import shared_memory
+from scipy import sparse
+from scipy.optimize import minimize, linprog, Bounds, OptimizeResult
+from typing import Optional
+from src.constraints import LinearConstraints
+from src.errors import InfeasibleAllocationError
+
+logger = logging.getLogger(__name__)
+
+SOLVERS = ('exact', 'lp', 'slsqp')
+# Securities per SLSQP subproblem. Only the PBs of a security are coupled and SLSQP's dense QP subproblem grows
+# cubically with the number of variables, so many small problems are much faster than a single one
+SLSQP_BLOCK_SIZE = 1
+
+
+def allocation_targets(trade: np.ndarray) -> np.ndarray:
+    """
+    Return the required sum of allocations for each security (1 when the trade is a buy, 0 otherwise)
+    :param trade:
+    :return:
+    """
+    return (trade > 0).astype(float)
+
+
+def cost_matrix(coefficients_matrix: np.ndarray, optimization_priorities: np.ndarray, trade: np.ndarray) -> np.ndarray:
+    """
+    Return the (pb, security) cost of allocating the full trade of a security to a PB. The objective in
+    PBOptimizer.calculate_metrics is linear in the allocations, so this matrix fully describes it up to a constant
+    :param coefficients_matrix: (pb, metric, security) array
+    :param optimization_priorities: (metric,) array
+    :param trade: (security,) array
+    :return: (pb, security) array
+    """
+    weighted = np.einsum('m,pms->ps', optimization_priorities, np.nan_to_num(coefficients_matrix))
+    return weighted * trade
+
+
+def sum_constraint_matrix(shape: tuple) -> sparse.csr_array:
+    """
+    Return the sparse (security, pb * security) matrix that sums the flattened allocations of each security
+    :param shape: (pb, security) shape of the allocation matrix
+    :return:
+    """
+    n_pbs, n_securities = shape
+    rows = np.tile(np.arange(n_securities), n_pbs)
+    cols = np.arange(n_pbs * n_securities)
+    data = np.ones(n_pbs * n_securities)
+    return sparse.csr_array((data, (rows, cols)), shape=(n_securities, n_pbs * n_securities))
+
+
+def solve_exact(cost: np.ndarray, targets: np.ndarray) -> tuple:
+    """
+    Closed form solution when the only constraints are the per-security sums: each traded security goes entirely to
+    its cheapest PB
+    :param cost: (pb, security) array
+    :param targets: (security,) array
+    :return: allocation matrix and OptimizeResult
+    """
+    allocations = np.zeros(cost.shape)
+    if cost.size:
+        allocations[np.argmin(cost, axis=0), np.arange(cost.shape[1])] = targets
+    result = OptimizeResult(x=allocations.reshape(-1), fun=float((cost * allocations).sum()), success=True,
+                            status=0, message='Closed form solution', nit=0)
+    return allocations, result
+
+
+def solve_lp(cost: np.ndarray, targets: np.ndarray, constraints: Optional[LinearConstraints] = None) -> tuple:
+    """
+    Solve the allocation as a linear program with HiGHS
+    :param cost: (pb, security) array
+    :param targets: (security,) array
+    :param constraints: [Optional] allocation constraints compiled for this problem
+    :return: allocation matrix and OptimizeResult
+    """
+    A_ub, b_ub, bounds = None, None, (0, 1)
+    if constraints is not None:
+        A_ub, b_ub = constraints.A_ub, constraints.b_ub
+        bounds = np.column_stack([np.zeros(cost.size), constraints.upper_bounds.reshape(-1)])
+    result = linprog(cost.reshape(-1), A_ub=A_ub, b_ub=b_ub, A_eq=sum_constraint_matrix(cost.shape), b_eq=targets,
+                     bounds=bounds, method='highs')
+    if not result.success:
+        return None, result
+    # HiGHS can return tiny negative values (and -0.0) for the bounds, adding 0.0 turns -0.0 into 0.0
+    allocations = np.clip(result.x, 0, 1) + 0.0
+    return allocations.reshape(cost.shape), result
+
+
+def solve_slsqp(objective, args: tuple, shape: tuple, targets: np.ndarray, gradient=None,
+                initial_allocations: np.ndarray = None, scale: float = 1.0) -> tuple:
+    """
+    Solve the allocation with SLSQP
+    :param objective: function of the flattened allocations and args
+    :param args: extra arguments passed to objective
+    :param shape: (pb, security) shape of the allocation matrix
+    :param targets: (security,) array
+    :param gradient: [Optional] analytic gradient of objective, finite differences are used if not provided
+    :param initial_allocations: [Optional] (pb, security) starting point, zeros if not provided
+    :param scale: the objective and gradient are divided by scale during the solve. SLSQP's tolerances are absolute,
+        so objectives in market value units need to be brought close to 1
+    :return: allocation matrix and OptimizeResult
+    """
+    if initial_allocations is None:
+        allocations_flat = np.zeros(shape=shape).reshape(-1)
+    else:
+        allocations_flat = np.asarray(initial_allocations, dtype=float).reshape(-1)
+
+    # Individual allocations must be between 0 and 1
+    bounds = Bounds(0, 1)
+
+    # A single vector valued constraint for all the per-security sums. The Jacobian is constant, SLSQP only accepts
+    # dense Jacobians so the sparse matrix is densified once here instead of on every iteration
+    sum_matrix = sum_constraint_matrix(shape)
+    sum_jacobian = sum_matrix.toarray()
+    constraints = [{'type': 'eq',
+                    'fun': lambda allocations_flat: sum_matrix @ allocations_flat - targets,
+                    'jac': lambda allocations_flat: sum_jacobian}]
+
+    # With the objective scaled close to 1 a tight tolerance stops SLSQP at the vertex instead of between two PBs
+    scaled_gradient = None
+    if gradient is not None:
+        scaled_gradient = lambda allocations_flat, *args: gradient(allocations_flat, *args) / scale
+    result = minimize(lambda allocations_flat, *args: objective(allocations_flat, *args) / scale, allocations_flat,
+                      args=args, jac=scaled_gradient, method='SLSQP', constraints=constraints, bounds=bounds,
+                      options={'ftol': 1e-10})
+    result.fun = result.fun * scale
+    return result.x.reshape(shape), result
+
+
+def solve_slsqp_blocks(objective, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
+                       optimization_priorities: np.ndarray, trade: np.ndarray, gradient=None,
+                       initial_allocations: np.ndarray = None, block_size: int = SLSQP_BLOCK_SIZE) -> tuple:
+    """
+    Solve the allocation with SLSQP, one block of block_size securities at a time. The objective is a sum over
+    securities and the constraints are per security, so the blocks are independent. Securities that are not bought
+    are not allocated and are skipped
+    :param objective: function of the flattened allocations, positions, coefficients, priorities and trade
+    :param positions_matrix: (pb, security) array
+    :param coefficients_matrix: (pb, metric, security) array
+    :param optimization_priorities: (metric,) array
+    :param trade: (security,) array
+    :param gradient: [Optional] analytic gradient of objective
+    :param initial_allocations: [Optional] (pb, security) starting point
+    :param block_size: securities per SLSQP problem
+    :return: allocation matrix and an OptimizeResult adding up the statistics of the blocks, its fun is the cost of
+        the allocation like solve_lp's
+    """
+    targets = allocation_targets(trade)
+    allocations = np.zeros(positions_matrix.shape)
+    bought = np.flatnonzero(targets)
+    results = []
+    for start in range(0, len(bought), block_size):
+        block = bought[start:start + block_size]
+        args = (positions_matrix[:, block], coefficients_matrix[..., block], optimization_priorities, trade[block])
+        initial = initial_allocations[:, block] if initial_allocations is not None else None
+        allocations[:, block], result = solve_slsqp(objective, args, (positions_matrix.shape[0], len(block)),
+                                                    targets[block], gradient, initial,
+                                                    scale=max(float(np.abs(trade[block]).max()), 1.0))
+        results.append(result)
+    failed = [result for result in results if not result.success]
+    message = f"{len(failed)} of {len(results)} blocks failed: {failed[0].message}" if failed \
+        else 'Optimization terminated successfully'
+    # Report the cost of the allocation like the LP backends, without the constant contribution of the positions
+    args = (positions_matrix, coefficients_matrix, optimization_priorities, trade)
+    fun = float(objective(allocations.reshape(-1), *args) - objective(np.zeros(allocations.size), *args))
+    result = OptimizeResult(x=allocations.reshape(-1), fun=fun, success=not failed,
+                            status=failed[0].status if failed else 0, message=message,
+                            nit=sum(int(result.nit) for result in results),
+                            nfev=sum(int(result.nfev) for result in results),
+                            njev=sum(int(result.get('njev', 0)) for result in results))
+    return allocations, result
+
+
+def solve_allocation(solver: str, objective, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
+                     optimization_priorities: np.ndarray, trade: np.ndarray, gradient=None,
+                     initial_allocations: np.ndarray = None,
+                     constraints: Optional[LinearConstraints] = None) -> tuple:
+    """
+    Dispatch the allocation problem to the requested solver backend. The LP backends fall back to SLSQP if they fail.
+    Problems with allocation constraints are always solved with HiGHS, the closed form and SLSQP only handle the
+    per-security sums
+    :param solver: one of SOLVERS
+    :param objective: objective function used by the SLSQP backend
+    :param positions_matrix: (pb, security) array
+    :param coefficients_matrix: (pb, metric, security) array
+    :param optimization_priorities: (metric,) array
+    :param trade: (security,) array
+    :param gradient: [Optional] analytic gradient of objective used by the SLSQP backend
+    :param initial_allocations: [Optional] (pb, security) starting point of the SLSQP backend, e.g. a previous
+        allocation of the same securities. HiGHS and the closed form do not take a starting point
+    :param constraints: [Optional] allocation constraints compiled for this problem
+    :return: allocation matrix and OptimizeResult
+    :raises InfeasibleAllocationError: if no allocation satisfies the constraints
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver '{solver}', expected one of {SOLVERS}")
+    constrained = constraints is not None and not constraints.is_empty
+    cost = cost_matrix(coefficients_matrix, optimization_priorities, trade) if solver != 'slsqp' or constrained \
+        else None
+    return _solve_with_cost(solver, cost, objective, positions_matrix, coefficients_matrix, optimization_priorities,
+                            trade, gradient, initial_allocations, constraints)
+
+
+def _solve_with_cost(solver: str, cost, objective, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
+                     optimization_priorities: np.ndarray, trade: np.ndarray, gradient=None,
+                     initial_allocations: np.ndarray = None,
+                     constraints: Optional[LinearConstraints] = None) -> tuple:
+    """
+    solve_allocation with the cost matrix already computed (None for SLSQP without constraints)
+    """
+    # e.g. an empty trade list, the backends do not take problems without variables
+    if not trade.size:
+        return np.zeros(positions_matrix.shape), OptimizeResult(x=np.zeros(0), fun=0.0, success=True, status=0,
+                                                                message='Empty problem', nit=0)
+    targets = allocation_targets(trade)
+    if constraints is not None and not constraints.is_empty:
+        if solver != 'lp':
+            logger.debug("Solving with HiGHS instead of '%s' because of the allocation constraints", solver)
+        allocations, result = solve_lp(cost, targets, constraints)
+        if allocations is None:
+            raise InfeasibleAllocationError(f"No allocation satisfies the allocation constraints ({result.message})")
+        return allocations, result
+    if solver != 'slsqp':
+        if solver == 'exact':
+            return solve_exact(cost, targets)
+        allocations, result = solve_lp(cost, targets)
+        if allocations is not None:
+            return allocations, result
+        logger.warning("LP solver failed (%s), falling back to SLSQP", result.message)
+    return solve_slsqp_blocks(objective, positions_matrix, coefficients_matrix, optimization_priorities, trade,
+                              gradient, initial_allocations)
+
+
+def solve_scenarios(solver: str, objective, positions_matrix: np.ndarray, coefficients_matrix: np.ndarray,
+                    priorities_matrix: np.ndarray, trade: np.ndarray, gradient=None,
+                    constraints: Optional[LinearConstraints] = None) -> tuple:
+    """
+    Solve the same allocation problem under several priority vectors. The costs of every scenario are computed in one
+    einsum, the closed form is solved for every scenario at once and the other backends (and every constrained
+    problem) solve one scenario at a time
+    :param solver: one of SOLVERS
+    :param objective: objective function used by the SLSQP backend
+    :param positions_matrix: (pb, security) array
+    :param coefficients_matrix: (pb, metric, security) array
+    :param priorities_matrix: (scenario, metric) array
+    :param trade: (security,) array
+    :param gradient: [Optional] analytic gradient of objective used by the SLSQP backend
+    :param constraints: [Optional] allocation constraints compiled for this problem, shared by every scenario
+    :return: (scenario, pb, security) allocations and the OptimizeResult of each scenario
+    """
+    if solver not in SOLVERS:
+        raise ValueError(f"Unknown solver '{solver}', expected one of {SOLVERS}")
+    n_scenarios = priorities_matrix.shape[0]
+    costs = np.einsum('nm,pms->nps', priorities_matrix, np.nan_to_num(coefficients_matrix)) * trade
+    if solver == 'exact' and (constraints is None or constraints.is_empty):
+        targets = allocation_targets(trade)
+        allocations = np.zeros(costs.shape)
+        if costs.size:
+            n_securities = costs.shape[2]
+            scenario_idx = np.repeat(np.arange(n_scenarios), n_securities)
+            security_idx = np.tile(np.arange(n_securities), n_scenarios)
+            allocations[scenario_idx, np.argmin(costs, axis=1).reshape(-1), security_idx] = np.tile(targets,
+                                                                                                   n_scenarios)
+        objectives = np.einsum('nps,nps->n', costs, allocations)
+        results = [OptimizeResult(x=allocations[i].reshape(-1), fun=float(objectives[i]), success=True, status=0,
+                                  message='Closed form solution', nit=0) for i in range(n_scenarios)]
+        return allocations, results
+
+    allocations = np.zeros(costs.shape)
+    results = []
+    for i in range(n_scenarios):
+        allocations[i], result = _solve_with_cost(solver, costs[i], objective, positions_matrix, coefficients_matrix,
+                                                  priorities_matrix[i], trade, gradient, constraints=constraints)
+        results.append(result)
+    return allocations, results
+
+
+def share_array(array: np.ndarray) -> tuple:
+    """
+    Copy array into a new shared memory block
+    :param array:
+    :return: the SharedMemory (owned by the caller, who must close and unlink it) and the spec to attach to it
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _solve_block(solver: str, objective, gradient, array_specs: dict, optimization_priorities: np.ndarray,
+                 start: int, stop: int) -> np.ndarray:
+    """
+    Solve the allocation of securities [start, stop) reading the inputs from shared memory. Runs in a worker process
+    """
+    blocks = {}
+    attached = []
+    try:
+        for key, (name, shape, dtype) in array_specs.items():
+            shm = shared_memory.SharedMemory(name=name)
+            attached.append(shm)
+            array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            blocks[key] = np.array(array[..., start:stop])
+    finally:
+        for shm in attached:
+            shm.close()
+    constraints = None
+    if 'upper_bounds' in blocks:
+        constraints = LinearConstraints(A_ub=None, b_ub=None, upper_bounds=blocks['upper_bounds'])
+    return solve_allocation(solver, objective, blocks['positions'], blocks['coefficients'], optimization_priorities,
+                            blocks['trade'], gradient, constraints=constraints)
+
+
+def solve_decomposed(executor: Executor, solver: str, objective, positions_matrix: np.ndarray,
+                     coefficients_matrix: np.ndarray, optimization_priorities: np.ndarray, trade: np.ndarray,
+                     n_blocks: int, gradient=None, upper_bounds: Optional[np.ndarray] = None) -> tuple:
+    """
+    Solve the allocation by splitting the securities in blocks solved concurrently in executor (a process pool).
+    This is exact because the per-security sums and bounds only involve one security, so it cannot be used with
+    constraints that couple securities. The inputs are placed in shared memory so only their names are sent to the
+    workers
+    :param executor:
+    :param solver: one of SOLVERS
+    :param objective: objective function used by the SLSQP backend, must be picklable
+    :param positions_matrix: (pb, security) array
+    :param coefficients_matrix: (pb, metric, security) array
+    :param optimization_priorities: (metric,) array
+    :param trade: (security,) array
+    :param n_blocks: number of blocks
+    :param gradient: [Optional] analytic gradient of objective, must be picklable
+    :param upper_bounds: [Optional] (pb, security) upper bounds of the allocations, e.g. from security limits
+    :return: (pb, security) allocation matrix and the OptimizeResult of each block
+    """
+    n_securities = positions_matrix.shape[1]
+    bounds = [(block[0], block[-1] + 1) for block in np.array_split(np.arange(n_securities), n_blocks) if block.size]
+    shared = []
+    try:
+        array_specs = {}
+        arrays = [('positions', positions_matrix), ('coefficients', coefficients_matrix), ('trade', trade)]
+        if upper_bounds is not None and not (upper_bounds >= 1).all():
+            arrays.append(('upper_bounds', upper_bounds))
+        for key, array in arrays:
+            shm, array_specs[key] = share_array(np.ascontiguousarray(array, dtype=float))
+            shared.append(shm)
+        futures = [executor.submit(_solve_block, solver, objective, gradient, array_specs, optimization_priorities,
+                                   start, stop) for start, stop in bounds]
+        allocations = np.zeros(positions_matrix.shape)
+        results = []
+        for future, (start, stop) in zip(futures, bounds):
+            allocations[:, start:stop], result = future.result()
+            results.append(result)
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+    return allocations, results
@@ -1,7 +1,24 @@
-
+import pandas as pd
 from dataclasses import dataclass
+from typing import Optional
 
 @dataclass
 class Trade:
     security_id: int
     market_value: float
+
+
+@dataclass
+class AllocationResult:
+    allocations: Optional[pd.DataFrame] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class ScenarioResult:
+    allocations: pd.DataFrame
+    # Objective of the allocation under the scenario's priorities
+    objective: float
+    # Metric totals over the traded securities after the allocation, and the same totals weighted by the priorities
+    metric_values: dict
+    metric_contributions: dict